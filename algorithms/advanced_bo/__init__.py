@@ -39,9 +39,16 @@ def optimize(evaluate, params):
     gp = OGP(ndim, hyps)
 
     # Create the bayesian optimizer that will use the gp as the model to optimize the machine
-    opt = BayesOpt(gp, evaluate, acq_func='UCB', start_dev_vals=start_point)
+    acq_func = params.get('acq_func', 'UCB')
+    opt = BayesOpt(gp, evaluate, acq_func=acq_func, start_dev_vals=start_point)
     opt.ucb_params = scan_params['ucb_params']  # set the acquisition function parameters
 
+    # Move cost model for the 'EIcost' acquisition function
+    move_cost_coeffs = params.get('move_cost_coeffs')
+    if move_cost_coeffs is not None:
+        opt.move_cost_coeffs = np.array(move_cost_coeffs, dtype=float)
+    opt.move_cost_offset = params.get('move_cost_offset', opt.move_cost_offset)
+
     # Running BO
     for i in range(n_iter):
         # print('iteration =', i)
@@ -12,6 +12,10 @@ Initialization parameters:
         'PI': uses probability of improvement. The interface should supply y-values.
         'EI': uses expected improvement. The interface should supply y-values.
         'UCB': uses GP upper confidence bound. No y-values needed.
+        'EIcost': uses expected improvement per unit of move cost, where the
+            cost of a move is move_cost_offset plus the step of each device
+            times its coefficient in move_cost_coeffs (see
+            negExpImprovePerCost). The interface should supply y-values.
         'testEI': uses EI over a finite set of points. This set must be
             provided as alt_param, and the interface need not supply
             meaningful y-values.
@@ -105,6 +109,10 @@ class BayesOpt:
 #        self.ucb_params = [0.24, 0.4] # [nu,delta] we like
         #self.ucb_params = [0.84, 1.0] # [nu,delta]
         self.ucb_params = [2., None] # if we want to used a fixed scale factor of the standard deviation
+        # move cost model for 'EIcost': fixed cost per evaluation plus a travel
+        # and settle cost per device proportional to its step (e.g. in seconds)
+        self.move_cost_offset = 1.
+        self.move_cost_coeffs = np.ones(np.array(start_dev_vals).size)
         self.max_iter = 100
         self.check = None
         self.alpha = 1
@@ -246,6 +254,11 @@ class BayesOpt:
             aqfcn = negExpImprove
             fargs = (self.model, y_best, self.acq_func[1], alpha)
 
+        # expected improvement per unit of move cost from the current setting
+        elif(self.acq_func[0] == 'EIcost'):
+            aqfcn = negExpImprovePerCost
+            fargs = (self.model, y_best, self.acq_func[1], x_curr, self.move_cost_coeffs, self.move_cost_offset)
+
         # gaussian process upper confidence bound acquisition function
         elif(self.acq_func[0] == 'UCB'):
             aqfcn = negUCB
@@ -331,10 +344,10 @@ class BayesOpt:
             else: # single-processing
 
                 if basinhoppingQ:
-                    res = basinhopping(aqfcn, x_start,niter=niter,niter_success=niter_success, minimizer_kwargs={'method':optmethod,'args':(self.model, y_best, self.acq_func[1], alpha),'tol':tolerance,'bounds':iter_bounds,'options':{'maxiter':maxiter}})
+                    res = basinhopping(aqfcn, x_start,niter=niter,niter_success=niter_success, minimizer_kwargs={'method':optmethod,'args':fargs,'tol':tolerance,'bounds':iter_bounds,'options':{'maxiter':maxiter}})
 
                 else:
-                    res = minimize(aqfcn, x_start, args=(self.model, y_best, self.acq_func[1], alpha), method=optmethod,tol=tolerance,bounds=iter_bounds,options={'maxiter':maxiter})
+                    res = minimize(aqfcn, x_start, args=fargs, method=optmethod,tol=tolerance,bounds=iter_bounds,options={'maxiter':maxiter})
 
                 res = res.x
 
@@ -380,6 +393,23 @@ def negExpImprove(x_new, model, y_best, xi, alpha=1.0):
     return alpha * (-EI) + (1. - alpha) * (-y_mean)
 
 
+def negExpImprovePerCost(x_new, model, y_best, xi, x_curr, cost_coeffs, cost_offset=1.0):
+    """
+    Expected improvement divided by the cost of moving the machine from its
+    current setting x_curr to x_new. The cost is modeled as a fixed
+    cost_offset (measurement time, minimum settle time) plus a travel and
+    settle time growing linearly with the step of each device, weighted by
+    the per-device cost_coeffs. Maximizing EI per cost favors the cheap
+    nearby moves unless a far one is expected to be much better, which
+    gives more improvement per wall-clock second rather than per evaluation.
+    """
+    EI = -negExpImprove(x_new, model, y_best, xi)
+    step = np.abs(np.ravel(x_new) - np.ravel(x_curr))
+    cost = cost_offset + np.sum(cost_coeffs * step)
+
+    return -EI / cost
+
+
 # GP upper confidence bound
 # original paper: https://arxiv.org/pdf/0912.3995.pdf
 # tutorial: http://www.cs.ubc.ca/~nando/540-2013/lectures/l7.pdf
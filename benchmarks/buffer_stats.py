@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of get_buffer_stats against computing the stats of each
+buffer with np.percentile, np.mean, np.median and np.std one by one.
+
+Run it from the repository root:
+
+    python benchmarks/buffer_stats.py
+"""
+import pathlib
+import sys
+import timeit
+import numpy as np
+
+# The lcls, lcls_h and lcls_ii environments share the same utils.py
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] /
+                       'lcls' / 'environments' / 'lcls'))
+from utils import get_buffer_stats  # noqa: E402
+
+BUFFER_SIZES = [100, 120, 1000, 2800]
+DETECTOR_COUNTS = [1, 2, 16, 64]
+NAN_FRACTION = 0.01
+
+
+def get_buffer_stats_per_pass(buffers):
+    # One np call per stat and per buffer, NaNs filtered out first
+    stats = []
+    for data in buffers:
+        data = data[~np.isnan(data)]
+        stats.append({
+            'percent_80': np.percentile(data, 80),
+            'mean': np.mean(data),
+            'median': np.median(data),
+            'std': np.std(data),
+        })
+
+    return stats
+
+
+def make_buffers(n_detectors, n_samples, rng):
+    buffers = rng.normal(1, 0.1, size=(n_detectors, n_samples))
+    buffers[rng.random(buffers.shape) < NAN_FRACTION] = np.nan
+
+    return buffers
+
+
+def main(number=200):
+    rng = np.random.default_rng(0)
+
+    print(f'{"detectors":>9} {"samples":>7} {"per pass [us]":>13} '
+          f'{"one pass [us]":>13} {"speedup":>7}')
+    for n_detectors in DETECTOR_COUNTS:
+        for n_samples in BUFFER_SIZES:
+            buffers = make_buffers(n_detectors, n_samples, rng)
+
+            # Both give the same numbers
+            stats = get_buffer_stats(buffers)
+            for i, stats_ref in enumerate(get_buffer_stats_per_pass(buffers)):
+                for name, value in stats_ref.items():
+                    assert np.isclose(stats[name][i], value), name
+
+            t_ref = timeit.timeit(
+                lambda: get_buffer_stats_per_pass(buffers), number=number)
+            t_new = timeit.timeit(
+                lambda: get_buffer_stats(buffers), number=number)
+            print(f'{n_detectors:>9} {n_samples:>7} '
+                  f'{t_ref / number * 1e6:>13.1f} '
+                  f'{t_new / number * 1e6:>13.1f} {t_ref / t_new:>7.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,8 @@ from badger.errors import (
     BadgerEnvObsError,
     BadgerInterfaceChannelError
 )
-from .utils import get_buffer_stats
+from .utils import (get_buffer_stats, get_standard_error, get_array_values,
+                    SettleTimeModel, FaultGate)
 
 
 class Environment(environment.Environment):
@@ -64,37 +65,94 @@ class Environment(environment.Environment):
     custom_acq_rate: float = 100  # for custom event code
     points: int = 100
     stats: str = 'percent_80'
+    # For method 2
+    acq_timeout: float = 10.0  # in second
+    # Adaptive acquisition for method 2: keep reading until the standard
+    # error of adaptive_stat ('percent_80', 'mean' or 'median') of the FEL
+    # intensity and of the beam loss is below adaptive_rel_error, or
+    # max_points is hit
+    adaptive: bool = False
+    adaptive_stat: str = 'percent_80'
+    adaptive_rel_error: float = 0.01
+    max_points: int = 1000
+    bounds_ttl: float = 60.0  # in second, how long the cached bounds are valid
     # Var setters
     use_check_var: bool = True  # if check var reaches the target value
     check_var_timeout: float = 3.0  # tumeout for the var check
     trim_delay: float = 7.0  # in second
+    start_timeout: float = 3.0  # in second, for the magnets to start moving
+    # Smallest tolerance on BACT w.r.t. the setpoint, in the magnet units. A
+    # magnet with a wider BDES/BACT deadband gets twice its deadband instead
+    settle_tolerance: float = 0.005
+    # Learn the settle time of each magnet against the size and direction of
+    # its steps. Without use_check_var, wait for the learned settle time
+    # instead of trim_delay once a magnet has settle_min_samples moves
+    learn_settle_time: bool = False
+    settle_min_samples: int = 5
     # MPS fault check
     use_check_fault: bool = True  # if check fault status
     check_fault_timeout: float = 5.0  # in second
+    check_ion_pump: bool = False  # if the NC ion pump vacuum is also checked
     # Other
     lasering: bool = True  # if it's lasering
 
+    # Private variables
+    _settle_model: SettleTimeModel = None
+    _bounds_cache: dict = {}  # variable -> {'bounds': ..., 'timestamp': ...}
+    _readbacks_start: dict = {}  # variable -> BACT before the last move
+    _deadbands: dict = {}  # variable -> largest BDES/BACT gap seen at rest
+    _fault_gate: FaultGate = None  # monitored beam fault status
+
     def get_bounds(self, variable_names):
         if self.interface is None:
             raise BadgerNoInterfaceError
 
-        pvs_low = [v + '.DRVL' for v in variable_names]
-        pvs_high = [v + '.DRVH' for v in variable_names]
-        bounds_low = self.interface.get_values(pvs_low)
-        bounds_high = self.interface.get_values(pvs_high)
+        # Serve the bounds from the cache, read the missing and the expired
+        # ones in one go
+        time_now = time.time()
+        missing = []
+        for v in variable_names:
+            entry = self._bounds_cache.get(v)
+            if entry is None or time_now - entry['timestamp'] > self.bounds_ttl:
+                missing.append(v)
+
+        fallback_bounds = {}
+        if missing:
+            pvs_low = [v + '.DRVL' for v in missing]
+            pvs_high = [v + '.DRVH' for v in missing]
+            bounds = self.interface.get_values(pvs_low + pvs_high)
+
+            for i, v in enumerate(missing):
+                bound_low = bounds[pvs_low[i]]
+                bound_high = bounds[pvs_high[i]]
+                if bound_low is None or bound_high is None:
+                    # Don't cache the fallback, try again next time
+                    fallback_bounds[v] = [-1000, 1000]
+                    continue
+
+                self._bounds_cache[v] = {
+                    'bounds': [bound_low, bound_high],
+                    'timestamp': time_now,
+                }
 
         bound_outputs = {}
-        for i, v in enumerate(variable_names):
-            if bounds_low[pvs_low[i]] is None or bounds_high[pvs_high[i]] is None:
-                bounds_low[pvs_low[i]] = -1000
-                bounds_high[pvs_high[i]] = 1000
-
-            bound_outputs[v] = [
-                bounds_low[pvs_low[i]],
-                bounds_high[pvs_high[i]]]
+        for v in variable_names:
+            if v in fallback_bounds:
+                bound_outputs[v] = fallback_bounds[v]
+            else:
+                bound_outputs[v] = list(self._bounds_cache[v]['bounds'])
 
         return bound_outputs
 
+    def invalidate_bounds(self, variable_names=None):
+        # Drop the cached bounds of the given variables, or of all of them
+        if variable_names is None:
+            self._bounds_cache.clear()
+            return
+
+        for v in variable_names:
+            self._bounds_cache.pop(v, None)
+
     def get_variables(self, variable_names: list[str]) -> dict:
         if self.interface is None:
             raise BadgerNoInterfaceError
@@ -129,16 +187,23 @@ class Environment(environment.Environment):
         if self.interface is None:
             raise BadgerNoInterfaceError
 
+        steps = self.get_steps(variable_inputs)
+        if self.learn_settle_time:
+            self.read_magnets(variable_inputs)
         self.interface.set_values(variable_inputs)
-        self.check_variables(variable_inputs)
+        self.check_variables(variable_inputs, steps)
 
-    def check_variables(self, variable_inputs):
-        # If use_check_var is False, we simply sleep for trim_delay seconds
+    def check_variables(self, variable_inputs, steps=None):
+        # If use_check_var is False, we simply sleep for trim_delay seconds,
         # else, we check if the variables have reached the target values, then
-        # sleep for trim_delay seconds
-
-        if not self.use_check_var:
-            if self.trim_delay:
+        # sleep for trim_delay seconds. See wait_for_trim for the learned
+        # settle time
+        if steps is None:
+            steps = {}
+
+        if not self.use_check_var or self.learn_settle_time:
+            self.wait_for_trim(variable_inputs, steps)
+            if self.use_check_var and self.trim_delay:
                 time.sleep(self.trim_delay)  # extra time for stablizing orbits
 
             return
@@ -186,11 +251,219 @@ class Environment(environment.Environment):
         if self.trim_delay:
             time.sleep(self.trim_delay)  # extra time for stablizing orbits
 
+    def get_steps(self, variable_inputs: dict[str, float]) -> dict:
+        # Step of each magnet in this move, only needed to learn settle times
+        names = [v for v in variable_inputs if v.endswith(':BCTRL')]
+        if not self.learn_settle_time or not names:
+            return {}
+
+        current_values = self.interface.get_values(names)
+
+        return {name: variable_inputs[name] - current_values[name]
+                for name in names if current_values[name] is not None}
+
+    def get_settle_model(self) -> SettleTimeModel:
+        if self._settle_model is None:
+            self._settle_model = SettleTimeModel(self.settle_min_samples)
+
+        return self._settle_model
+
+    def record_settle_times(self, steps: dict, settle_times: dict,
+                            timeout: float, offset: float = 0.0):
+        # The magnets missing from settle_times did not settle within
+        # timeout, we only know that they take longer. Those that had
+        # settled before we looked (None) tell us nothing
+        if not self.learn_settle_time:
+            return
+
+        model = self.get_settle_model()
+        for name, step in steps.items():
+            if name not in settle_times:
+                model.record(name, step, timeout, censored=True)
+            elif settle_times[name] is not None:
+                model.record(name, step, offset + settle_times[name])
+
+    def wait_for_trim(self, variable_inputs: dict[str, float],
+                      steps: dict) -> bool:
+        # Wait for the magnets after a move: until they have settled (up to
+        # check_var_timeout) with use_check_var, else for trim_delay. With
+        # learn_settle_time we watch them meanwhile to learn how long they
+        # take, and once the model knows all of them we sleep for their
+        # predicted settle time instead, then only check the readbacks as a
+        # guard. Return False if the magnets did not settle in time
+        if not self.learn_settle_time:
+            if self.use_check_var:
+                return self.wait_for_magnets(variable_inputs)
+
+            if self.trim_delay:
+                time.sleep(self.trim_delay)  # extra time for stablizing orbits
+
+            return True
+
+        if self.use_check_var:
+            timeout = self.check_var_timeout
+        else:
+            timeout = self.trim_delay
+        model = self.get_settle_model()
+        predictions = [model.predict(name, step)
+                       for name, step in steps.items()]
+
+        time_start = time.time()
+        settle_times = {}
+        if not predictions or None in predictions:
+            settled = self.wait_for_magnets(variable_inputs, timeout=timeout,
+                                            settle_times=settle_times)
+            self.record_settle_times(steps, settle_times, timeout)
+            if not self.use_check_var:  # keep the usual delay while learning
+                time.sleep(max(timeout - (time.time() - time_start), 0))
+
+            return settled
+
+        wait = max(predictions)
+        logging.info(f'Predicted settle time: {wait:.2f} s')
+        time.sleep(min(wait, timeout))
+
+        settled = self.wait_for_magnets(variable_inputs,
+                                        timeout=max(timeout - wait, 0),
+                                        settle_times=settle_times,
+                                        wait_start=False)
+        self.record_settle_times(steps, settle_times, max(timeout, wait),
+                                 offset=wait)
+
+        return settled
+
+    def get_magnets(self, variable_inputs: dict[str, float]) -> dict:
+        # variable -> magnet device, for the BCTRL variables
+        return {v: v[:v.rfind(':')] for v in variable_inputs
+                if v.endswith(':BCTRL')}
+
+    def read_magnets(self, variable_inputs: dict[str, float]):
+        # Take the readback of the magnets right before moving them, to see
+        # when they start moving. The BDES/BACT gap of a magnet at rest tells
+        # us its deadband, i.e. how close to the setpoint it will settle
+        magnets = self.get_magnets(variable_inputs)
+        if not magnets:
+            return
+
+        channel_names = []
+        for magnet in magnets.values():
+            channel_names += [f'{magnet}:STATCTRLSUB.T', f'{magnet}:BDES',
+                              f'{magnet}:BACT']
+        values = self.interface.get_values(channel_names)
+
+        for name, magnet in magnets.items():
+            flag = values[f'{magnet}:STATCTRLSUB.T']
+            setpoint = values[f'{magnet}:BDES']
+            readback = values[f'{magnet}:BACT']
+            self._readbacks_start[name] = readback
+            if flag is None or flag or setpoint is None or readback is None:
+                continue  # not at rest
+
+            self._deadbands[name] = max(self._deadbands.get(name, 0),
+                                        abs(setpoint - readback))
+
+    def get_settle_tolerance(self, variable_name: str) -> float:
+        deadband = self._deadbands.get(variable_name, 0)
+
+        return max(2 * deadband, self.settle_tolerance)
+
+    def wait_for_magnets(self, variable_inputs: dict[str, float],
+                         timeout: float = None,
+                         settle_times: dict = None,
+                         wait_start: bool = True) -> bool:
+        # Wait (up to start_timeout) for the magnets to start moving, i.e.
+        # for their ready flag to be set or their BACT readback to leave its
+        # value before the move. A magnet has then settled once its flag is
+        # cleared and its readback is within its settle tolerance of the
+        # setpoint. Return False if the magnets did not settle within timeout
+        # (check_var_timeout by default). The time each magnet took since
+        # the call goes into settle_times, None if it had already settled
+        # when we first looked
+        if timeout is None:
+            timeout = self.check_var_timeout
+
+        magnets = self.get_magnets(variable_inputs)
+        if not magnets:
+            return True
+
+        channel_names = []
+        for magnet in magnets.values():
+            channel_names += [f'{magnet}:STATCTRLSUB.T', f'{magnet}:BACT']
+
+        tolerances = {name: self.get_settle_tolerance(name)
+                      for name in magnets}
+        readbacks_start = {name: self._readbacks_start.get(name)
+                           for name in magnets}
+
+        # Steps within the tolerance may not move the magnet at all
+        if wait_start:
+            started = {name for name, start in readbacks_start.items()
+                       if start is not None and
+                       abs(variable_inputs[name] - start) <= tolerances[name]}
+        else:
+            started = set(magnets)
+        moving = set(magnets) - started
+
+        time_start = time.time()
+
+        def is_started(values):
+            for name, magnet in magnets.items():
+                flag = values[f'{magnet}:STATCTRLSUB.T']
+                readback = values[f'{magnet}:BACT']
+                start = readbacks_start[name]
+                if flag or (readback is not None and start is not None and
+                            abs(readback - start) > tolerances[name]):
+                    started.add(name)
+                    moving.add(name)
+
+            return len(started) == len(magnets)
+
+        def is_settled(values):
+            settled = True
+            for name, magnet in magnets.items():
+                flag = values[f'{magnet}:STATCTRLSUB.T']
+                readback = values[f'{magnet}:BACT']
+                if flag is None or flag or readback is None or \
+                        abs(readback - variable_inputs[name]) > \
+                        tolerances[name]:
+                    settled = False
+                    moving.add(name)
+                elif settle_times is not None and name not in settle_times:
+                    settle_times[name] = (time.time() - time_start
+                                          if name in moving else None)
+
+            return settled
+
+        if len(started) < len(magnets):
+            if not self.wait_for_channels(channel_names, is_started,
+                                          self.start_timeout):
+                logging.debug('Magnets did not start moving in '
+                              f'{self.start_timeout} s: '
+                              f'{sorted(set(magnets) - started)}')
+
+        return self.wait_for_channels(channel_names, is_settled, timeout)
+
+    def wait_for_channels(self, channel_names: list[str], condition,
+                          timeout: float) -> bool:
+        # Let the interface wake us up on the monitor updates if it can
+        if hasattr(self.interface, 'wait_for_values'):
+            return self.interface.wait_for_values(
+                channel_names, condition, timeout=timeout)
+
+        time_start = time.time()
+        while not condition(self.interface.get_values(channel_names)):
+            if time.time() - time_start > timeout:
+                return False
+
+            time.sleep(0.1)
+
+        return True
+
     def get_intensity_n_loss(self):
         # self.method
         # 0: scalar
         # 1: BSA buffer
-        # 2: manually data collection
+        # 2: BSA buffer aligned on pulse ID
         if self.method == 0:
             req_rate = self.interface.get_value('TPG:SYS0:1:DST04:REQRATE')
 
@@ -225,33 +498,19 @@ class Environment(environment.Environment):
             points = self.points
             logging.info(f'Get value of {points} points')
 
-            req_rate = self.interface.get_value('TPG:SYS0:1:DST04:REQRATE')
-
-            if not req_rate:
-                raise BadgerEnvObsError
-
-            req_rate = float(req_rate)
-            if self.event_code == 'SCS':
-                if req_rate < 100:
-                    PV_gas = 'EM1K0:GMD:HPS:milliJoulesPerPulseHSTSCSTH'
-                    PV_loss = f'{self.loss_pv}HSTSCSTH'
-                    rate = 10
-                else:
-                    PV_gas = 'EM1K0:GMD:HPS:milliJoulesPerPulseHSTSCSHH'
-                    PV_loss = f'{self.loss_pv}HSTSCSHH'
-                    rate = 100
-            else:
-                PV_gas = f'EM1K0:GMD:HPS:milliJoulesPerPulseHST{self.event_code}'
-                PV_loss = f'{self.loss_pv}HST{self.event_code}'
-                rate = self.custom_acq_rate
+            buffer_suffix, rate = self.get_buffer_suffix()
+            PV_gas = f'EM1K0:GMD:HPS:milliJoulesPerPulse{buffer_suffix}'
+            PV_loss = f'{self.loss_pv}{buffer_suffix}'
             logging.info(f'Data acquisition rate: {rate} Hz')
 
             # Wait enough time to accumulate sufficient data points in buffers
             nap_time = points / rate
             time.sleep(nap_time)
 
-            # Filter out the NaNs
-            results_dict = self.interface.get_values([PV_gas, PV_loss])
+            # Only fetch the tails of the buffers, then filter out the NaNs
+            results_dict = get_array_values(
+                self.interface, [PV_gas, PV_loss],
+                {PV_gas: -points, PV_loss: -points})
             intensity_raw = results_dict[PV_gas][-points:]
             loss_raw = results_dict[PV_loss][-points:]
             ind_valid = ~np.logical_or(np.isnan(intensity_raw), np.isnan(loss_raw))
@@ -264,43 +523,211 @@ class Environment(environment.Environment):
 
             logging.info(f'Valid point number in buffer: {n_valid}')
 
-            stats_intensity = get_buffer_stats(intensity_valid)
-            stats_loss = get_buffer_stats(loss_valid)
+            # Stats of both buffers in one pass
+            stats = get_buffer_stats([intensity_valid, loss_valid])
 
-            return stats_intensity['percent_80'], \
-                stats_intensity['mean'], \
-                stats_intensity['median'], \
-                stats_intensity['std'], \
-                stats_loss[self.stats]
+            return stats['percent_80'][0], \
+                stats['mean'][0], \
+                stats['median'][0], \
+                stats['std'][0], \
+                stats[self.stats][1]
         elif self.method == 2:
-            raise NotImplementedError
+            return self.get_aligned_intensity_n_loss()
         else:
             raise NotImplementedError
 
-    def check_fault_status(self):
+    def get_buffer_suffix(self):
+        # Return the BSA buffer suffix and its acquisition rate
+        req_rate = self.interface.get_value('TPG:SYS0:1:DST04:REQRATE')
+
+        if not req_rate:
+            raise BadgerEnvObsError
+
+        req_rate = float(req_rate)
+        if self.event_code == 'SCS':
+            if req_rate < 100:
+                return 'HSTSCSTH', 10
+            else:
+                return 'HSTSCSHH', 100
+
+        return f'HST{self.event_code}', self.custom_acq_rate
+
+    @staticmethod
+    def get_pid_pv(pv, buffer_suffix=''):
+        # The pulse ID buffer of a signal lives on the same device, e.g.
+        # LBLM:COL0:862:A:I0_LOSS -> LBLM:COL0:862:A:PID
+        return f'{pv.rsplit(":", 1)[0]}:PID{buffer_suffix}'
+
+    def has_enough_shots(self, intensity, loss):
+        # Without adaptive acquisition we simply want points shots, else
+        # we keep going until the requested statistic of both buffers is
+        # known well enough, or we hit max_points
+        n_shots = len(intensity)
+        if n_shots < self.points:
+            return False
+
+        if not self.adaptive or n_shots >= self.max_points:
+            return True
+
+        values = get_buffer_stats([intensity, loss])[self.adaptive_stat]
+        for data, value in zip([intensity, loss], values):
+            error = get_standard_error(data, self.adaptive_stat)
+            if error > self.adaptive_rel_error * (abs(value) + 1e-8):
+                return False
+
+        return True
+
+    def get_aligned_intensity_n_loss(self):
+        # Read the gas detector and loss monitor buffers together with their
+        # pulse ID buffers, and pair the shots on pulse ID instead of on
+        # array position. Only shots newer than the first read are used, and
+        # we return as soon as there are enough of them
+        points = self.points
+        logging.info(f'Get value of {points} pulse ID aligned points')
+
+        buffer_suffix, rate = self.get_buffer_suffix()
+        gas_pv = 'EM1K0:GMD:HPS:milliJoulesPerPulse'
+        PV_gas = f'{gas_pv}{buffer_suffix}'
+        PV_loss = f'{self.loss_pv}{buffer_suffix}'
+        PV_gas_pid = self.get_pid_pv(gas_pv, buffer_suffix)
+        PV_loss_pid = self.get_pid_pv(self.loss_pv, buffer_suffix)
+        logging.info(f'Data acquisition rate: {rate} Hz')
+
+        # Read a margin on top of the requested points, since the two buffers
+        # are not updated at exactly the same time
+        pvs = [PV_gas, PV_gas_pid, PV_loss, PV_loss_pid]
+        n_max = self.max_points if self.adaptive else points
+        counts = {pv: -2 * n_max for pv in pvs}
+
+        pid_start = None
+        time_start = time.time()
+        while True:
+            results_dict = get_array_values(self.interface, pvs, counts)
+            intensity_raw = np.asarray(results_dict[PV_gas])
+            pid_gas = np.asarray(results_dict[PV_gas_pid])
+            loss_raw = np.asarray(results_dict[PV_loss])
+            pid_loss = np.asarray(results_dict[PV_loss_pid])
+
+            if len(intensity_raw) != len(pid_gas) or \
+               len(loss_raw) != len(pid_loss):
+                raise BadgerEnvObsError(
+                    'Buffers and pulse ID buffers have different lengths!')
+
+            if pid_start is None:  # only use the shots taken from now on
+                pid_start = max(np.nanmax(pid_gas), np.nanmax(pid_loss))
+
+            _, ind_gas, ind_loss = np.intersect1d(
+                pid_gas, pid_loss, return_indices=True)
+            intensity_aligned = intensity_raw[ind_gas]
+            loss_aligned = loss_raw[ind_loss]
+            ind_valid = (pid_gas[ind_gas] > pid_start) & \
+                ~np.isnan(intensity_aligned) & ~np.isnan(loss_aligned)
+            n_valid = np.count_nonzero(ind_valid)
+
+            if self.has_enough_shots(intensity_aligned[ind_valid],
+                                     loss_aligned[ind_valid]):
+                break
+
+            if time.time() - time_start > self.acq_timeout:
+                if not n_valid:
+                    raise BadgerEnvObsError('No valid aligned shots in buffer!')
+
+                logging.warning(
+                    f'Only got {n_valid} aligned points in {self.acq_timeout} s')
+                break
+
+            # Wait for roughly the missing number of shots, adaptive
+            # acquisition checks back every tenth of the points
+            time.sleep(max(points - n_valid, points // 10, 1) / rate)
+
+        # intersect1d sorts by pulse ID, so the newest shots are at the end
+        n_used = n_max if self.adaptive else points
+        intensity_valid = intensity_aligned[ind_valid][-n_used:]
+        loss_valid = loss_aligned[ind_valid][-n_used:]
+        logging.info(f'Valid aligned point number: {len(intensity_valid)}')
+
+        # Stats of both buffers in one pass
+        stats = get_buffer_stats([intensity_valid, loss_valid])
+
+        return stats['percent_80'][0], \
+            stats['mean'][0], \
+            stats['median'][0], \
+            stats['std'][0], \
+            stats[self.stats][1]
+
+    def get_fault_pvs(self):
         if self.lasering:
             MPS_PV = 'SIOC:SYS0:MP00:SC_SXR_BC'
         else:
             MPS_PV = 'SIOC:SYS0:MP00:SC_BSYD_BC'
 
-        NC_lion_PV = 'LION:LTU0:716:VACT'
+        fault_pvs = [MPS_PV]
+        if self.check_ion_pump:
+            fault_pvs.append('LION:LTU0:716:VACT')
+
+        return fault_pvs
+
+    def is_beam_ok(self, fault_states):
+        # req_rate = self.interface.get_value('TPG:SYS0:1:DST04:REQRATE')
+        # act_rate = self.interface.get_value('TPG:SYS0:1:DST04:RATE')
+        # is_rate_matched = (req_rate == act_rate)
         NC_lion_threshold = 0.5
 
-        ts_start = time.time()
-        while True:
-            # req_rate = self.interface.get_value('TPG:SYS0:1:DST04:REQRATE')
-            # act_rate = self.interface.get_value('TPG:SYS0:1:DST04:RATE')
-            # is_rate_matched = (req_rate == act_rate)
+        fault_pvs = self.get_fault_pvs()
+        permit_MPS = fault_states[fault_pvs[0]]
+        is_beam_on = (permit_MPS != 'Beam Off')
+
+        if self.check_ion_pump:
+            NC_lion = fault_states['LION:LTU0:716:VACT']
+            is_NC_OK = (NC_lion is not None) and \
+                (float(NC_lion) < NC_lion_threshold)
+
+            return is_NC_OK and is_beam_on
+
+        return is_beam_on
+
+    def get_fault_gate(self):
+        # Fault gate fed by the monitor updates of the fault PVs, None if the
+        # interface cannot subscribe to them
+        fault_pvs = self.get_fault_pvs()
+        gate = self._fault_gate
+        if gate is not None:
+            if gate.connected and gate.interface is self.interface and \
+                    gate.channel_names == fault_pvs:
+                return gate
+
+            gate.close()
+            self._fault_gate = None
 
-            is_NC_OK = self.interface.get_value(NC_lion_PV) < NC_lion_threshold
+        if not hasattr(self.interface, 'subscribe'):
+            return None
 
-            permit_MPS = self.interface.get_value(
-                MPS_PV, as_string=True)
-            is_beam_on = (permit_MPS != 'Beam Off')
+        gate = FaultGate(self.interface, fault_pvs, self.is_beam_ok)
+        if not gate.connected:
+            # Drop the subscription, the next check builds a new gate
+            gate.close()
+            return None
+
+        self._fault_gate = gate
+
+        return gate
+
+    def check_fault_status(self):
+        # Answer right away from the monitored status, and only block while
+        # a fault is actually active
+        gate = self.get_fault_gate()
+        if gate is not None:
+            if not gate.wait(self.check_fault_timeout):
+                raise BadgerEnvObsError
+
+            return
+
+        fault_pvs = self.get_fault_pvs()
+        ts_start = time.time()
+        while True:
+            fault_states = self.interface.get_values(fault_pvs, as_string=True)
 
-            # if is_rate_matched and is_beam_on:
-            # if is_NC_OK and is_beam_on:
-            if is_beam_on:
+            if self.is_beam_ok(fault_states):
                 break
             else:
                 ts_curr = time.time()
@@ -1,4 +1,7 @@
+import logging
 import random
+import time
+import numpy as np
 import epics
 from badger import interface
 
@@ -10,10 +13,27 @@ class Interface(interface.Interface):
 
     testing: bool = False
     timeout: float = None
+    # Keep the channels alive between calls instead of clearing the CA cache
+    persistent: bool = False
+    # Recreate a channel after this many failures in a row
+    max_failures: int = 3
+    # Read array heads/tails through the IOC array filter (needs EPICS base
+    # >= 3.15 and no CA gateway in between), falls back on the full array if
+    # the filtered read fails
+    array_filter: bool = False
+
+    # Private variables
+    _health: dict = {}  # channel -> {'failures': ..., 'last_ok': ...}
+    _unfiltered: set = set()  # channels that cannot be read through the filter
 
     @interface.log
-    def get_values(self, channel_names, as_string: bool = False):
-        epics.ca.clear_cache()
+    def get_values(
+        self, channel_names, as_string: bool = False, counts: dict = None
+    ):
+        # counts maps channel -> number of elements to read for array PVs,
+        # a negative count reads the tail of the array, like [count:]
+        if not self.persistent:
+            epics.ca.clear_cache()
 
         channel_outputs = {}
 
@@ -25,17 +45,53 @@ class Interface(interface.Interface):
 
             return channel_outputs
 
+        if counts is None:
+            counts = {}
+        channel_names = list(channel_names)
+        pv_names = [
+            self._get_pv_name(channel, counts.get(channel))
+            for channel in channel_names
+        ]
+
         values = epics.caget_many(
-            channel_names, as_string=as_string, timeout=self.timeout
+            pv_names, as_string=as_string, timeout=self.timeout
         )
+
+        # Read the channels the IOC (or a gateway) cannot filter in full, they
+        # are sliced locally by _trim, and do not ask for the filter again
+        fallback = [
+            i for i, channel in enumerate(channel_names)
+            if values[i] is None and pv_names[i] != channel
+        ]
+        if fallback:
+            fallback_values = epics.caget_many(
+                [channel_names[i] for i in fallback], as_string=as_string,
+                timeout=self.timeout
+            )
+            for i, value in zip(fallback, fallback_values):
+                if value is None:
+                    continue
+                self._unfiltered.add(channel_names[i])
+                pv_names[i] = channel_names[i]
+                values[i] = value
+
         for i, channel in enumerate(channel_names):
-            channel_outputs[channel] = values[i]
+            channel_outputs[channel] = self._trim(
+                values[i], counts.get(channel)
+            )
+
+        if self.persistent:
+            self._update_health(
+                {pv_name: values[i] is not None for i, pv_name in
+                 enumerate(pv_names)}
+            )
 
         return channel_outputs
 
     @interface.log
     def set_values(self, channel_inputs: dict) -> dict:
-        epics.ca.clear_cache()
+        if not self.persistent:
+            epics.ca.clear_cache()
 
         channel_flags = {}
 
@@ -53,4 +109,60 @@ class Interface(interface.Interface):
         for i, channel in enumerate(pvlist):
             channel_flags[channel] = flags[i]
 
+        if self.persistent:
+            self._update_health(
+                {channel: flag == 1 for channel, flag in channel_flags.items()}
+            )
+
         return channel_flags
+
+    def _get_pv_name(self, channel: str, count: int = None) -> str:
+        # Let the IOC cut the array with a server side filter,
+        # so that only the requested elements cross the wire
+        if not self.array_filter or not count or channel in self._unfiltered:
+            return channel
+
+        if count > 0:
+            return f'{channel}.{{"arr":{{"s":0,"e":{count - 1}}}}}'
+
+        return f'{channel}.{{"arr":{{"s":{count}}}}}'
+
+    @staticmethod
+    def _trim(value, count: int = None):
+        # Slicing gives a view, nothing is copied
+        if not count or not isinstance(value, np.ndarray):
+            return value
+
+        if count > 0:
+            return value[:count]
+
+        return value[count:]
+
+    def _update_health(self, channel_status: dict):
+        for channel, ok in channel_status.items():
+            health = self._health.setdefault(
+                channel, {"failures": 0, "last_ok": None}
+            )
+
+            if ok:
+                health["failures"] = 0
+                health["last_ok"] = time.time()
+                continue
+
+            health["failures"] += 1
+            if health["failures"] >= self.max_failures:
+                self._reset_channel(channel)
+                health["failures"] = 0
+
+    @staticmethod
+    def _reset_channel(channel: str):
+        # Only drop the broken channel, the next call creates it again.
+        # create_channel returns the cached chid if the channel exists
+        logging.warning(f"Channel {channel} keeps failing, reconnecting")
+        try:
+            chid = epics.ca.create_channel(
+                channel, connect=False, auto_cb=False
+            )
+            epics.ca.clear_channel(chid)
+        except epics.ca.ChannelAccessException as e:
+            logging.warning(f"Failed to reset channel {channel}: {e}")
@@ -1,7 +1,7 @@
 import time
 import numpy as np
 from badger import environment
-from badger.errors import BadgerNotImplementedError
+from badger.errors import BadgerEnvObsError, BadgerNotImplementedError
 
 
 class Environment(environment.Environment):
@@ -24,6 +24,10 @@ class Environment(environment.Environment):
     # use_check_var: bool = True  # if check var reaches the target value
     trim_delay: float = 3.0  # in second
     sample_delay: float = 0.1
+    buffered: bool = True  # acquire the samples from the channel monitors
+    sample_timeout: float = 10.0  # in second
+    blen_min: float = 3100.0  # bunch length window of a valid sample
+    blen_max: float = 3600.0
     # fault_timeout: float = 5.0  # in second
 
     def get_bounds(self, variable_names):
@@ -70,12 +74,8 @@ class Environment(environment.Environment):
 
         observable_outputs = {}
 
-        data = []
-        for _ in range(self.n_samples):
-            data += [self._get_single_sample()]
-            time.sleep(self.sample_delay)
-
-        data = np.mean(np.array(data), axis=-1)
+        _, data = self.get_samples()
+        data = np.mean(data, axis=0)
 
         all_outputs = {
             "eloss": data[-3],
@@ -98,24 +98,79 @@ class Environment(environment.Environment):
 
         return observable_outputs
 
-    def _get_single_sample(self):
-        valid = False
-        ts = 0
-        datarec = None
-        while not valid:
-            data_dict = self.interface.get_values(self.pv_name_list)
-            datarec = [data_dict[pv] for pv in self.pv_name_list]
-            if datarec[-1] > 3100:
-                if datarec[-1] < 3600:
-                    valid = True
+    def get_samples(self):
+        # Acquire time-stamped rows of pv_name_list readings until n_samples
+        # of them have the bunch length (last channel) within the window.
+        # Return the timestamps and the valid rows, oldest first
+        assert self.interface, "Must provide an interface!"
+
+        samples = []  # (timestamp, row), appended from the CA thread if buffered
+        subscription = None
+        if self.buffered and hasattr(self.interface, "subscribe"):
+            subscription = self._subscribe_samples(samples)
+
+        ts_start = time.time()
+        n_valid = 0
+        try:
+            while True:
+                if subscription is None:
+                    self._poll_samples(samples, self.n_samples - n_valid)
                 else:
-                    ts = ts + 1
-            else:
-                ts = ts + 1
-            if ts > 10:
-                break
+                    time.sleep(self.sample_delay)
+
+                block = samples[:]
+                valid = self._get_valid_mask(block)
+                n_valid = np.count_nonzero(valid)
+                if n_valid >= self.n_samples:
+                    break
+                if time.time() - ts_start > self.sample_timeout:
+                    break
+        finally:
+            if subscription is not None:
+                self.interface.unsubscribe(subscription)
+
+        idx_valid = np.flatnonzero(valid)[: self.n_samples]
+        if not len(idx_valid):
+            raise BadgerEnvObsError(
+                f"No sample with the bunch length within [{self.blen_min}, "
+                f"{self.blen_max}] in {self.sample_timeout} s"
+            )
+
+        timestamps = np.array([block[i][0] for i in idx_valid])
+        data = np.array([block[i][1] for i in idx_valid], dtype=float)
+
+        return timestamps, data
+
+    def _subscribe_samples(self, samples):
+        # Take a row of the latest readings each time the bunch length updates
+        pv_name_list = self.pv_name_list
+        trigger = pv_name_list[-1]
+        latest = {}
+
+        def on_change(channel, value):
+            latest[channel] = value
+            if channel == trigger and len(latest) == len(pv_name_list):
+                row = [latest[pv] for pv in pv_name_list]
+                samples.append((time.time(), row))
+
+        return self.interface.subscribe(pv_name_list, on_change)
+
+    def _poll_samples(self, samples, n_rows):
+        for i in range(n_rows):
+            if i:
+                time.sleep(self.sample_delay)
+            data_dict = self.interface.get_values(self.pv_name_list)
+            row = [data_dict[pv] for pv in self.pv_name_list]
+            samples.append((time.time(), row))
+
+    def _get_valid_mask(self, samples):
+        if not samples:
+            return np.zeros(0, dtype=bool)
+
+        # Disconnected channels (None) become NaN and fail the comparisons
+        blen = np.array([row[-1] for _, row in samples], dtype=float)
 
-        return datarec
+        return (blen > self.blen_min) & (blen < self.blen_max)
 
     @property
     def pv_name_list(self):
@@ -102,36 +102,75 @@ class Environment(environment.Environment):
 
         self._modified = False
 
-        # Predict with model
-        model = self._model
+        # Model inputs for the current variable values
+        x_in = self.get_model_inputs([[self._variables[var] for var in
+                                       self.variable_names]])
+
+        # Update predictions
+        self._observations.update(self.predict(x_in))
+
+        return {k: self._observations[k] for k in observable_names}
+
+    def get_observables_batch(self, x, variable_names=None,
+                              observable_names=None):
+        # Evaluate the model on many points at once, without touching the
+        # environment state. x is (n_points, n_variables), in the order of
+        # variable_names (all the variables by default). Return
+        # {observable: (n_points,) array}
+        if variable_names is None:
+            variable_names = self.variable_names
+        if observable_names is None:
+            observable_names = self.observables
+
+        # Lazy loading
+        if self._model is None:
+            self.load_model()
+
+        x_in = self.get_model_inputs(x, variable_names)
+        observations = self.predict(x_in)
+
+        return {k: observations[k] for k in observable_names}
 
+    def get_model_inputs(self, x, variable_names=None):
+        # Fill the variable values of x (n_points, n_variables) into copies
+        # of the reference point, around which to optimize
+        if variable_names is None:
+            variable_names = self.variable_names
+
+        model = self._model
         assert model is not None, 'Model failed to initialize!'
 
-        # Make input array of length model_in_list (inputs model takes)
-        x_in = np.empty((1, len(model.model_in_list)))
+        x = np.asarray(x, dtype=float)
+        if x.ndim != 2 or x.shape[1] != len(variable_names):
+            raise ValueError(
+                f'Expected x of shape (n_points, {len(variable_names)}), '
+                f'got {x.shape}')
 
-        # Fill in reference point around which to optimize
+        x_in = np.empty((x.shape[0], len(model.model_in_list)))
         x_in[:, :] = np.asarray(self._ref_point)
 
         # Set solenoid, SQ, CQ to values from optimization step
-        for var in self.variable_names:
-            x_in[:, model.loc_in[var]] = self._variables[var]
+        for i, var in enumerate(variable_names):
+            x_in[:, model.loc_in[var]] = x[:, i]
 
-        # Update predictions
+        return x_in
+
+    def predict(self, x_in):
+        # All the observables for the model inputs x_in, in one prediction
+        model = self._model
         y_out = model.pred_machine_units(x_in)
-        self._observations['sigma_x'] = \
-            y_out[:, model.loc_out['sigma_x']] * 1e3  # in mm
-        self._observations['sigma_y'] = \
-            y_out[:, model.loc_out['sigma_y']] * 1e3  # in mm
-        self._observations['sigma_z'] = \
-            y_out[:, model.loc_out['sigma_z']] * 1e3  # in mm?
-        self._observations['norm_emit_x'] = \
-            nemit_x = y_out[:, model.loc_out['norm_emit_x']] * 1e6  # in um
-        self._observations['norm_emit_y'] = \
-            nemit_y = y_out[:, model.loc_out['norm_emit_y']] * 1e6  # in um
-        self._observations['norm_emit'] = np.sqrt(nemit_x * nemit_y)  # in um
 
-        return {k: self._observations[k] for k in observable_names}
+        nemit_x = y_out[:, model.loc_out['norm_emit_x']] * 1e6  # in um
+        nemit_y = y_out[:, model.loc_out['norm_emit_y']] * 1e6  # in um
+
+        return {
+            'sigma_x': y_out[:, model.loc_out['sigma_x']] * 1e3,  # in mm
+            'sigma_y': y_out[:, model.loc_out['sigma_y']] * 1e3,  # in mm
+            'sigma_z': y_out[:, model.loc_out['sigma_z']] * 1e3,  # in mm?
+            'norm_emit_x': nemit_x,
+            'norm_emit_y': nemit_y,
+            'norm_emit': np.sqrt(nemit_x * nemit_y),  # in um
+        }
 
     def load_model(self):
         # Lazy importing
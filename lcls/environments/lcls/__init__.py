@@ -1,10 +1,15 @@
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 from typing import Dict, List
 from badger import environment
-from badger.stats import percent_80
 from badger.errors import BadgerEnvObsError, BadgerInterfaceChannelError
 import logging
+from .utils import (get_buffer_stats, get_standard_error, get_array_values,
+                    SettleTimeModel, FaultGate)
+
+
+PULSEID_MAX = 131040  # LCLS pulse IDs wrap around at this value
 
 
 class Environment(environment.Environment):
@@ -84,31 +89,98 @@ class Environment(environment.Environment):
     beamsize_monitor: str = '541'  # BPM channel for beam size
     loss_pv: str = 'LBLM:COL0:862:A:I0_LOSSHSTSCS'  # PV name for loss monitor
 
+    bounds_ttl: float = 60.0  # in second, how long the cached bounds are valid
+
     use_check_var: bool = True  # if check var reaches the target value
     check_var_timeout: float = 3.0  # tumeout for the var check
     trim_delay: float = 3.0  # in second
+    start_timeout: float = 3.0  # in second, for the magnets to start moving
+    # Smallest tolerance on BACT w.r.t. the setpoint, in the magnet units. A
+    # magnet with a wider BDES/BACT deadband gets twice its deadband instead
+    settle_tolerance: float = 0.005
+    # Learn the settle time of each magnet against the size and direction of
+    # its steps. Without use_check_var, wait for the learned settle time
+    # instead of trim_delay once a magnet has settle_min_samples moves
+    learn_settle_time: bool = False
+    settle_min_samples: int = 5
     check_fault_timeout: float = 5.0  # in second
 
+    # Return as soon as enough new shots are in the buffers, instead of
+    # sleeping for points / rate
+    streaming: bool = False
+    pid_pv: str = 'PATT:SYS0:1:PULSEID'  # pulse ID, buffer suffix is added
+    stream_timeout: float = 10.0  # in second
+    # Keep collecting shots until the relative standard error of the
+    # adaptive_stat ('percent_80', 'mean' or 'median') of the FEL intensity
+    # and of the beam loss is below adaptive_rel_error, or max_points is hit
+    adaptive: bool = False
+    adaptive_stat: str = 'percent_80'
+    adaptive_rel_error: float = 0.01
+    max_points: int = 1200
+
+    # Attach the system states to each observation, as 'system_states'. They
+    # are read in the background while waiting for the beam
+    snapshot_states: bool = False
     epsilon: float = 1e-8  # avoid divided by zero in relative FEL jitter
 
+    # Private variables
+    _pid_last: float = None  # newest pulse ID seen before the next shots
+    _settle_model: SettleTimeModel = None
+    _bounds_cache: Dict = {}  # variable -> {'bounds': ..., 'timestamp': ...}
+    _readbacks_start: Dict = {}  # variable -> BACT before the last move
+    _deadbands: Dict = {}  # variable -> largest BDES/BACT gap seen at rest
+    _states_executor: ThreadPoolExecutor = None  # reads the states snapshot
+    _fault_gate: FaultGate = None  # monitored beam fault status
+
     def get_bounds(self, variable_names):
         assert self.interface, 'Must provide an interface!'
 
-        pvs_low = [v + '.DRVL' for v in variable_names]
-        pvs_high = [v + '.DRVH' for v in variable_names]
-        bounds_low = self.interface.get_values(pvs_low)
-        bounds_high = self.interface.get_values(pvs_high)
+        # Serve the bounds from the cache, read the missing and the expired
+        # ones in one go
+        time_now = time.time()
+        missing = []
+        for v in variable_names:
+            entry = self._bounds_cache.get(v)
+            if entry is None or time_now - entry['timestamp'] > self.bounds_ttl:
+                missing.append(v)
+
+        fallback_bounds = {}
+        if missing:
+            pvs_low = [v + '.DRVL' for v in missing]
+            pvs_high = [v + '.DRVH' for v in missing]
+            bounds = self.interface.get_values(pvs_low + pvs_high)
+
+            for i, v in enumerate(missing):
+                bound_low = bounds[pvs_low[i]]
+                bound_high = bounds[pvs_high[i]]
+                if bound_low is None or bound_high is None:
+                    # Don't cache the fallback, try again next time
+                    fallback_bounds[v] = [-1000, 1000]
+                    continue
+
+                self._bounds_cache[v] = {
+                    'bounds': [bound_low, bound_high],
+                    'timestamp': time_now,
+                }
 
         bound_outputs = {}
-        for i, v in enumerate(variable_names):
-            if bounds_low[pvs_low[i]] is None or bounds_high[pvs_high[i]] is None:
-                bounds_low[pvs_low[i]] = -1000
-                bounds_high[pvs_high[i]] = 1000
-
-            bound_outputs[v] = [bounds_low[pvs_low[i]], bounds_high[pvs_high[i]]]
+        for v in variable_names:
+            if v in fallback_bounds:
+                bound_outputs[v] = fallback_bounds[v]
+            else:
+                bound_outputs[v] = list(self._bounds_cache[v]['bounds'])
 
         return bound_outputs
 
+    def invalidate_bounds(self, variable_names=None):
+        # Drop the cached bounds of the given variables, or of all of them
+        if variable_names is None:
+            self._bounds_cache.clear()
+            return
+
+        for v in variable_names:
+            self._bounds_cache.pop(v, None)
+
     def get_variables(self, variable_names: List[str]) -> Dict:
         assert self.interface, 'Must provide an interface!'
 
@@ -143,28 +215,226 @@ class Environment(environment.Environment):
         if self.readonly:
             return
 
+        # Only the shots taken after this move count for streaming
+        self._pid_last = None
+
+        steps = self.get_steps(variable_inputs)
+        if self.use_check_var or self.learn_settle_time:
+            self.read_magnets(variable_inputs)
         self.interface.set_values(variable_inputs)
 
-        if not self.use_check_var:
+        settled = self.wait_for_trim(variable_inputs, steps)
+        if self.use_check_var and not settled:
+            logging.warning('Magnets did not settle in '
+                            f'{self.check_var_timeout} s')
+
+    def get_steps(self, variable_inputs: Dict[str, float]) -> Dict:
+        # Step of each magnet in this move, only needed to learn settle times
+        names = [v for v in variable_inputs if v.endswith(':BCTRL')]
+        if not self.learn_settle_time or not names:
+            return {}
+
+        current_values = self.interface.get_values(names)
+
+        return {name: variable_inputs[name] - current_values[name]
+                for name in names if current_values[name] is not None}
+
+    def get_settle_model(self) -> SettleTimeModel:
+        if self._settle_model is None:
+            self._settle_model = SettleTimeModel(self.settle_min_samples)
+
+        return self._settle_model
+
+    def record_settle_times(self, steps: Dict, settle_times: Dict,
+                            timeout: float, offset: float = 0.0):
+        # The magnets missing from settle_times did not settle within
+        # timeout, we only know that they take longer. Those that had
+        # settled before we looked (None) tell us nothing
+        if not self.learn_settle_time:
+            return
+
+        model = self.get_settle_model()
+        for name, step in steps.items():
+            if name not in settle_times:
+                model.record(name, step, timeout, censored=True)
+            elif settle_times[name] is not None:
+                model.record(name, step, offset + settle_times[name])
+
+    def wait_for_trim(self, variable_inputs: Dict[str, float],
+                      steps: Dict) -> bool:
+        # Wait for the magnets after a move: until they have settled (up to
+        # check_var_timeout) with use_check_var, else for trim_delay. With
+        # learn_settle_time we watch them meanwhile to learn how long they
+        # take, and once the model knows all of them we sleep for their
+        # predicted settle time instead, then only check the readbacks as a
+        # guard. Return False if the magnets did not settle in time
+        if not self.learn_settle_time:
+            if self.use_check_var:
+                return self.wait_for_magnets(variable_inputs)
+
             if self.trim_delay:
                 time.sleep(self.trim_delay)  # extra time for stablizing orbits
 
+            return True
+
+        if self.use_check_var:
+            timeout = self.check_var_timeout
+        else:
+            timeout = self.trim_delay
+        model = self.get_settle_model()
+        predictions = [model.predict(name, step)
+                       for name, step in steps.items()]
+
+        time_start = time.time()
+        settle_times = {}
+        if not predictions or None in predictions:
+            settled = self.wait_for_magnets(variable_inputs, timeout=timeout,
+                                            settle_times=settle_times)
+            self.record_settle_times(steps, settle_times, timeout)
+            if not self.use_check_var:  # keep the usual delay while learning
+                time.sleep(max(timeout - (time.time() - time_start), 0))
+
+            return settled
+
+        wait = max(predictions)
+        logging.info(f'Predicted settle time: {wait:.2f} s')
+        time.sleep(min(wait, timeout))
+
+        settled = self.wait_for_magnets(variable_inputs,
+                                        timeout=max(timeout - wait, 0),
+                                        settle_times=settle_times,
+                                        wait_start=False)
+        self.record_settle_times(steps, settle_times, max(timeout, wait),
+                                 offset=wait)
+
+        return settled
+
+    def get_magnets(self, variable_inputs: Dict[str, float]) -> Dict:
+        # variable -> magnet device, for the BCTRL variables
+        return {v: v[:v.rfind(':')] for v in variable_inputs
+                if v.endswith(':BCTRL')}
+
+    def read_magnets(self, variable_inputs: Dict[str, float]):
+        # Take the readback of the magnets right before moving them, to see
+        # when they start moving. The BDES/BACT gap of a magnet at rest tells
+        # us its deadband, i.e. how close to the setpoint it will settle
+        magnets = self.get_magnets(variable_inputs)
+        if not magnets:
             return
 
-        variable_ready_flags = [v[:v.rfind(':')] + ':STATCTRLSUB.T'
-                                for v in variable_inputs
-                                if v.endswith(':BCTRL')]
-        variable_status = self.interface.get_values(variable_ready_flags)
+        channel_names = []
+        for magnet in magnets.values():
+            channel_names += [f'{magnet}:STATCTRLSUB.T', f'{magnet}:BDES',
+                              f'{magnet}:BACT']
+        values = self.interface.get_values(channel_names)
+
+        for name, magnet in magnets.items():
+            flag = values[f'{magnet}:STATCTRLSUB.T']
+            setpoint = values[f'{magnet}:BDES']
+            readback = values[f'{magnet}:BACT']
+            self._readbacks_start[name] = readback
+            if flag is None or flag or setpoint is None or readback is None:
+                continue  # not at rest
+
+            self._deadbands[name] = max(self._deadbands.get(name, 0),
+                                        abs(setpoint - readback))
+
+    def get_settle_tolerance(self, variable_name: str) -> float:
+        deadband = self._deadbands.get(variable_name, 0)
+
+        return max(2 * deadband, self.settle_tolerance)
+
+    def wait_for_magnets(self, variable_inputs: Dict[str, float],
+                         timeout: float = None,
+                         settle_times: Dict = None,
+                         wait_start: bool = True) -> bool:
+        # Wait (up to start_timeout) for the magnets to start moving, i.e.
+        # for their ready flag to be set or their BACT readback to leave its
+        # value before the move. A magnet has then settled once its flag is
+        # cleared and its readback is within its settle tolerance of the
+        # setpoint. Return False if the magnets did not settle within timeout
+        # (check_var_timeout by default). The time each magnet took since
+        # the call goes into settle_times, None if it had already settled
+        # when we first looked
+        if timeout is None:
+            timeout = self.check_var_timeout
+
+        magnets = self.get_magnets(variable_inputs)
+        if not magnets:
+            return True
+
+        channel_names = []
+        for magnet in magnets.values():
+            channel_names += [f'{magnet}:STATCTRLSUB.T', f'{magnet}:BACT']
+
+        tolerances = {name: self.get_settle_tolerance(name)
+                      for name in magnets}
+        readbacks_start = {name: self._readbacks_start.get(name)
+                           for name in magnets}
+
+        # Steps within the tolerance may not move the magnet at all
+        if wait_start:
+            started = {name for name, start in readbacks_start.items()
+                       if start is not None and
+                       abs(variable_inputs[name] - start) <= tolerances[name]}
+        else:
+            started = set(magnets)
+        moving = set(magnets) - started
+
+        time_start = time.time()
+
+        def is_started(values):
+            for name, magnet in magnets.items():
+                flag = values[f'{magnet}:STATCTRLSUB.T']
+                readback = values[f'{magnet}:BACT']
+                start = readbacks_start[name]
+                if flag or (readback is not None and start is not None and
+                            abs(readback - start) > tolerances[name]):
+                    started.add(name)
+                    moving.add(name)
+
+            return len(started) == len(magnets)
+
+        def is_settled(values):
+            settled = True
+            for name, magnet in magnets.items():
+                flag = values[f'{magnet}:STATCTRLSUB.T']
+                readback = values[f'{magnet}:BACT']
+                if flag is None or flag or readback is None or \
+                        abs(readback - variable_inputs[name]) > \
+                        tolerances[name]:
+                    settled = False
+                    moving.add(name)
+                elif settle_times is not None and name not in settle_times:
+                    settle_times[name] = (time.time() - time_start
+                                          if name in moving else None)
+
+            return settled
+
+        if len(started) < len(magnets):
+            if not self.wait_for_channels(channel_names, is_started,
+                                          self.start_timeout):
+                logging.debug('Magnets did not start moving in '
+                              f'{self.start_timeout} s: '
+                              f'{sorted(set(magnets) - started)}')
+
+        return self.wait_for_channels(channel_names, is_settled, timeout)
+
+    def wait_for_channels(self, channel_names: List[str], condition,
+                          timeout: float) -> bool:
+        # Let the interface wake us up on the monitor updates if it can
+        if hasattr(self.interface, 'wait_for_values'):
+            return self.interface.wait_for_values(
+                channel_names, condition, timeout=timeout)
 
         time_start = time.time()
-        while np.any(np.array(variable_status.values())):
-            time.sleep(0.1 * np.random.rand())
+        while not condition(self.interface.get_values(channel_names)):
+            if time.time() - time_start > timeout:
+                return False
 
-            variable_status = self.interface.get_values(variable_ready_flags)
+            time.sleep(0.1)
 
-            time_elapsed = time.time() - time_start
-            if time_elapsed > self.check_var_timeout:
-                break
+        return True
 
     def get_intensity_n_loss(self):
         # At lcls the repetition is 120 Hz and the readout buf size is 2800.
@@ -174,6 +444,9 @@ class Environment(environment.Environment):
         points = self.points
         logging.info(f'Get value of {points} points')
 
+        if self.streaming or self.adaptive:
+            return self.stream_intensity_n_loss()
+
         # Sleep for a while to get enough data
         try:
             rate = self.interface.get_value('EVNT:SYS0:1:LCLSBEAMRATE')
@@ -193,19 +466,139 @@ class Environment(environment.Environment):
             PV_gas = 'EM1K0:GMD:HPS:milliJoulesPerPulseHSTCUSBR'
         PV_loss = self.loss_pv
         try:
-            results_dict = self.interface.get_values([PV_gas, PV_loss])
+            # Only fetch the tails of the buffers
+            results_dict = get_array_values(
+                self.interface, [PV_gas, PV_loss],
+                {PV_gas: -points, PV_loss: -points})
             intensity_raw = results_dict[PV_gas][-points:]
             loss_raw = results_dict[PV_loss][-points:]
             ind_valid = ~np.logical_or(np.isnan(intensity_raw), np.isnan(loss_raw))
             intensity_valid = intensity_raw[ind_valid]
             loss_valid = loss_raw[ind_valid]
 
-            gas_p80 = percent_80(intensity_valid)
-            gas_mean = np.mean(intensity_valid)
-            gas_median = np.median(intensity_valid)
-            gas_std = np.std(intensity_valid)
+            # Stats of both buffers in one pass
+            stats = get_buffer_stats([intensity_valid, loss_valid])
+            gas_p80, loss_p80 = stats['percent_80']
+            gas_mean = stats['mean'][0]
+            gas_median = stats['median'][0]
+            gas_std = stats['std'][0]
+
+            return gas_p80, gas_mean, gas_median, gas_std, loss_p80
+        except Exception:  # if average fails use the scalar input
+            if hxr:  # we don't have scalar input for HXR
+                raise BadgerEnvObsError
+            else:
+                gas = self.interface.get_value('EM1K0:GMD:HPS:milliJoulesPerPulse')
+
+                return gas, gas, gas, 0, 0
+
+    def stream_buffers(self, pvs, is_enough):
+        # Follow the newest entries of the buffers, only keep the shots with
+        # a pulse ID newer than the last one we have seen (and valid in all
+        # the buffers), until is_enough(shots) says we can stop. The
+        # reference pulse ID is reset by set_variables, so the first read
+        # only sets it
+        try:
+            rate = self.interface.get_value('EVNT:SYS0:1:LCLSBEAMRATE')
+            logging.info(f'Beam rate: {rate}')
+            rate = float(rate) or 120.0
+        except Exception:
+            rate = 120.0
+
+        if self.hxr:
+            PV_pid = f'{self.pid_pv}HSTCUHBR'
+        else:  # SXR
+            PV_pid = f'{self.pid_pv}HSTCUSBR'
+        # Leave some margin in case the buffers move on between two reads
+        window = 2 * self.points
+        counts = {pv: -window for pv in pvs + [PV_pid]}
 
-            loss_p80 = percent_80(loss_valid)
+        shots = {pv: np.empty(0) for pv in pvs}
+        time_start = time.time()
+        while True:
+            results_dict = get_array_values(
+                self.interface, pvs + [PV_pid], counts)
+            pid_raw = results_dict[PV_pid]
+
+            if self._pid_last is None:
+                self._pid_last = pid_raw[~np.isnan(pid_raw)][-1]
+            else:
+                # Pulse IDs wrap around, compare them modulo PULSEID_MAX
+                pid_diff = (pid_raw - self._pid_last) % PULSEID_MAX
+                ind_valid = (pid_diff > 0) & (pid_diff < PULSEID_MAX / 2)
+                if np.any(ind_valid):
+                    self._pid_last = pid_raw[ind_valid][-1]
+
+                for pv in pvs:
+                    ind_valid &= ~np.isnan(results_dict[pv])
+                for pv in pvs:
+                    shots[pv] = np.concatenate(
+                        [shots[pv], results_dict[pv][ind_valid]])
+
+            n_shots = len(shots[pvs[0]])
+            if n_shots and is_enough(shots):
+                break
+
+            if time.time() - time_start > self.stream_timeout:
+                logging.warn(
+                    f'Only got {n_shots} new points in {self.stream_timeout} s')
+                break
+
+            # Wait for roughly the missing number of shots, adaptive
+            # acquisition keeps going in small chunks
+            n_missing = max(self.points - n_shots, self.points // 10, 1)
+            time.sleep(n_missing / rate)
+
+        return shots
+
+    def has_enough_shots(self, *buffers):
+        # Without adaptive acquisition we simply want points shots, else
+        # we keep going until the requested statistic of every buffer is
+        # known well enough, or we hit max_points
+        n_shots = len(buffers[0])
+        if n_shots < self.points:
+            return False
+
+        if not self.adaptive or n_shots >= self.max_points:
+            return True
+
+        values = get_buffer_stats(buffers)[self.adaptive_stat]
+        for data, value in zip(buffers, values):
+            error = get_standard_error(data, self.adaptive_stat)
+            if error > self.adaptive_rel_error * (abs(value) + self.epsilon):
+                return False
+
+        return True
+
+    def stream_intensity_n_loss(self):
+        hxr = self.hxr
+        points = self.points
+
+        if hxr:
+            PV_gas = f'GDET:FEE1:{self.fel_channel}:ENRCHSTCUHBR'
+        else:  # SXR
+            PV_gas = 'EM1K0:GMD:HPS:milliJoulesPerPulseHSTCUSBR'
+        PV_loss = self.loss_pv
+
+        try:
+            shots = self.stream_buffers(
+                [PV_gas, PV_loss],
+                lambda shots: self.has_enough_shots(shots[PV_gas], shots[PV_loss]))
+            # Adaptive acquisition uses all the shots, else the newest points
+            if self.adaptive:
+                intensity_valid = shots[PV_gas]
+                loss_valid = shots[PV_loss]
+            else:
+                intensity_valid = shots[PV_gas][-points:]
+                loss_valid = shots[PV_loss][-points:]
+            logging.info(f'Valid point number: {len(intensity_valid)}')
+
+            # Stats of both buffers in one pass
+            stats = get_buffer_stats([intensity_valid, loss_valid])
+            gas_p80, loss_p80 = stats['percent_80']
+            gas_mean = stats['mean'][0]
+            gas_median = stats['median'][0]
+            gas_std = stats['std'][0]
 
             return gas_p80, gas_mean, gas_median, gas_std, loss_p80
         except Exception:  # if average fails use the scalar input
@@ -216,10 +609,29 @@ class Environment(environment.Environment):
 
                 return gas, gas, gas, 0, 0
 
+    def stream_loss(self):
+        PV_loss = self.loss_pv
+
+        try:
+            shots = self.stream_buffers(
+                [PV_loss], lambda shots: self.has_enough_shots(shots[PV_loss]))
+            if self.adaptive:
+                loss_valid = shots[PV_loss]
+            else:
+                loss_valid = shots[PV_loss][-self.points:]
+            loss_p80 = get_buffer_stats(loss_valid)['percent_80']
+
+            return loss_p80
+        except Exception:  # we don't have scalar input for loss
+            raise BadgerEnvObsError
+
     def get_loss(self):  # if only loss is observed
         points = self.points
         logging.info(f'Get value of {points} points')
 
+        if self.streaming or self.adaptive:
+            return self.stream_loss()
+
         try:
             rate = self.interface.get_value('EVNT:SYS0:1:LCLSBEAMRATE')
             logging.info(f'Beam rate: {rate}')
@@ -234,10 +646,12 @@ class Environment(environment.Environment):
 
         PV_loss = self.loss_pv
         try:
-            loss_raw = self.interface.get_value(PV_loss)[-points:]
+            results_dict = get_array_values(
+                self.interface, [PV_loss], {PV_loss: -points})
+            loss_raw = results_dict[PV_loss][-points:]
             ind_valid = ~np.isnan(loss_raw)
             loss_valid = loss_raw[ind_valid]
-            loss_p80 = percent_80(loss_valid)
+            loss_p80 = get_buffer_stats(loss_valid)['percent_80']
 
             return loss_p80
         except Exception:  # we don't have scalar input for loss
@@ -250,6 +664,26 @@ class Environment(environment.Environment):
     def is_beam_loss_observed(self, observable_names):
         return 'beam_loss' in observable_names
 
+    def get_observable_registry(self):
+        # Observable name -> (PVs it needs, how to compute it from their values)
+        mid = self.beamsize_monitor
+        PV_bs_x = f'OTRS:IN20:{mid}:XRMS'
+        PV_bs_y = f'OTRS:IN20:{mid}:YRMS'
+
+        return {
+            'energy': (['BEND:DMPH:400:BDES'], lambda energy: energy),
+            'charge': (['SIOC:SYS0:ML00:CALC252'], lambda charge: charge),
+            'current': (['BLEN:LI24:886:BIMAX'], lambda current: current),
+            'beamrate': (['EVNT:SYS0:1:LCLSBEAMRATE'], lambda rate: rate),
+            'beamsize_x': ([PV_bs_x], lambda bs_x: bs_x),
+            'beamsize_y': ([PV_bs_y], lambda bs_y: bs_y),
+            'beamsize_r': ([PV_bs_x, PV_bs_y],
+                           lambda bs_x, bs_y: np.linalg.norm([bs_x, bs_y])),
+            'beamsize_g': ([PV_bs_x, PV_bs_y],
+                           lambda bs_x, bs_y: np.sqrt(bs_x * bs_y)),
+            'pulse_id': (['PATT:SYS0:1:PULSEID'], lambda pid: pid),
+        }
+
     def get_observables(self, observable_names: List[str]) -> Dict:
         assert self.interface, 'Must provide an interface!'
 
@@ -259,35 +693,30 @@ class Environment(environment.Environment):
         observe_gas = self.is_pulse_intensity_observed(observable_names)
         observe_loss = self.is_beam_loss_observed(observable_names)
 
+        take_snapshot = self.snapshot_states and (observe_gas or observe_loss)
+        states_future = None
+        if take_snapshot:
+            states_future = self.start_states_snapshot()
+
         if observe_gas:
             intensity_p80, intensity_mean, intensity_median, intensity_std, \
                 loss_p80 = self.get_intensity_n_loss()
         elif observe_loss:
             loss_p80 = self.get_loss()
 
+        # Read the PVs of all the requested scalar observables in one go,
+        # each PV only once, so that they all come from the same instant
+        registry = self.get_observable_registry()
+        pvs = [pv for obs in observable_names if obs in registry
+               for pv in registry[obs][0]]
+        pvs = list(dict.fromkeys(pvs))
+        values = self.interface.get_values(pvs) if pvs else {}
+
         observable_outputs = {}
-        mid = self.beamsize_monitor
         for obs in observable_names:
-            if obs == 'energy':
-                value = self.interface.get_value('BEND:DMPH:400:BDES')
-            elif obs == 'charge':
-                value = self.interface.get_value('SIOC:SYS0:ML00:CALC252')
-            elif obs == 'current':
-                value = self.interface.get_value('BLEN:LI24:886:BIMAX')
-            elif obs == 'beamrate':
-                value = self.interface.get_value('EVNT:SYS0:1:LCLSBEAMRATE')
-            elif obs == 'beamsize_x':
-                value = self.interface.get_value(f'OTRS:IN20:{mid}:XRMS')
-            elif obs == 'beamsize_y':
-                value = self.interface.get_value(f'OTRS:IN20:{mid}:YRMS')
-            elif obs == 'beamsize_r':
-                bs_x = self.interface.get_value(f'OTRS:IN20:{mid}:XRMS')
-                bs_y = self.interface.get_value(f'OTRS:IN20:{mid}:YRMS')
-                value = np.linalg.norm([bs_x, bs_y])
-            elif obs == 'beamsize_g':
-                bs_x = self.interface.get_value(f'OTRS:IN20:{mid}:XRMS')
-                bs_y = self.interface.get_value(f'OTRS:IN20:{mid}:YRMS')
-                value = np.sqrt(bs_x * bs_y)
+            if obs in registry:
+                obs_pvs, compute = registry[obs]
+                value = compute(*[values[pv] for pv in obs_pvs])
             elif obs == 'beam_loss':
                 value = loss_p80
             elif obs == 'pulse_intensity_p80':
@@ -300,26 +729,73 @@ class Environment(environment.Environment):
                 value = intensity_std
             elif obs == 'pulse_intensity_std_relative':
                 value = intensity_std / (intensity_mean + self.epsilon)
-            elif obs == 'pulse_id':
-                value = self.interface.get_value('PATT:SYS0:1:PULSEID')
             else:  # won't happen actually
                 value = None
 
             observable_outputs[obs] = value
 
+        if take_snapshot:
+            if states_future is not None:
+                system_states = states_future.result()
+            else:
+                system_states = self.get_system_states()
+            observable_outputs['system_states'] = system_states
+
         return observable_outputs
 
+    def get_fault_pvs(self):
+        return ['IOC:BSY0:MP01:PC_RATE', 'BCS:MCC0:1:BEAMPMSV']
+
+    def is_beam_ok(self, fault_states):
+        rate_MPS = fault_states['IOC:BSY0:MP01:PC_RATE']
+        permit_BCS = fault_states['BCS:MCC0:1:BEAMPMSV']
+
+        return (rate_MPS == '120 Hz') and (permit_BCS == 'OK')
+
+    def get_fault_gate(self):
+        # Fault gate fed by the monitor updates of the fault PVs, None if the
+        # interface cannot subscribe to them
+        fault_pvs = self.get_fault_pvs()
+        gate = self._fault_gate
+        if gate is not None:
+            if gate.connected and gate.interface is self.interface and \
+                    gate.channel_names == fault_pvs:
+                return gate
+
+            gate.close()
+            self._fault_gate = None
+
+        if not hasattr(self.interface, 'subscribe'):
+            return None
+
+        gate = FaultGate(self.interface, fault_pvs, self.is_beam_ok)
+        if not gate.connected:
+            # Drop the subscription, the next check builds a new gate
+            gate.close()
+            return None
+
+        self._fault_gate = gate
+
+        return gate
+
     def check_fault_status(self):
         assert self.interface, 'Must provide an interface!'
 
+        # Answer right away from the monitored status, and only block while
+        # a fault is actually active
+        gate = self.get_fault_gate()
+        if gate is not None:
+            if not gate.wait(self.check_fault_timeout):
+                raise BadgerEnvObsError
+
+            return
+
+        fault_pvs = self.get_fault_pvs()
         ts_start = time.time()
         while True:
-            rate_MPS = self.interface.get_value('IOC:BSY0:MP01:PC_RATE',
-                                                as_string=True)
-            permit_BCS = self.interface.get_value('BCS:MCC0:1:BEAMPMSV',
-                                                  as_string=True)
+            fault_states = self.interface.get_values(fault_pvs, as_string=True)
 
-            if (rate_MPS == '120 Hz') and (permit_BCS == 'OK'):
+            if self.is_beam_ok(fault_states):
                 break
             else:
                 ts_curr = time.time()
@@ -329,6 +805,19 @@ class Environment(environment.Environment):
 
                 time.sleep(0.1 * np.random.rand())
 
+    def start_states_snapshot(self) -> Future:
+        # Read the system states on a background thread, so that they are
+        # read while we wait for the beam shots instead of after them. Return
+        # None if the interface cannot be shared with another thread: a non
+        # persistent epics_raw clears the channels after each call
+        if not getattr(self.interface, 'persistent', True):
+            return None
+
+        if self._states_executor is None:
+            self._states_executor = ThreadPoolExecutor(max_workers=1)
+
+        return self._states_executor.submit(self.get_system_states)
+
     def get_system_states(self):
         assert self.interface, 'Must provide an interface!'
 
@@ -401,9 +890,11 @@ class Environment(environment.Environment):
         ]
 
         try:
-            states_general = self.interface.get_values(general_pvs)
-            states_quads = self.interface.get_values(matching_quads)
-            states_extra = self.interface.get_values(extra_pvs)
+            states = self.interface.get_values(
+                general_pvs + matching_quads + extra_pvs)
+            states_general = {pv: states[pv] for pv in general_pvs}
+            states_quads = {pv: states[pv] for pv in matching_quads}
+            states_extra = {pv: states[pv] for pv in extra_pvs}
 
             system_states = {
                 'HXR electron energy [GeV]': states_general['BEND:DMPH:400:BDES'],
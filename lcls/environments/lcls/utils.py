@@ -0,0 +1,188 @@
+import threading
+import numpy as np
+
+
+QUANTILES = {
+    'percent_80': 0.8,
+    'median': 0.5,
+}
+
+
+def get_buffer_stats(data, quantiles=QUANTILES):
+    # Quantiles, mean and std of a buffer, or of stacked buffers (one per row)
+    # at once, leaving the NaNs out. All the quantiles come from a single
+    # partition of the data instead of one sort per statistic
+    data = np.asarray(data, dtype=float)
+    stacked = data.ndim > 1
+    data = np.atleast_2d(data)
+
+    mask = np.isnan(data)
+    n = data.shape[1] - np.count_nonzero(mask, axis=1)
+    if not n.all():
+        raise ValueError('No valid sample in buffer!')
+
+    has_nan = mask.any()
+    if has_nan:  # push the NaNs to the end of each row
+        data = np.where(mask, np.inf, data)
+
+    # Linear interpolation between the closest ranks, like np.percentile
+    positions = np.outer(n - 1, list(quantiles.values()))
+    ranks_low = np.floor(positions).astype(int)
+    ranks_high = np.ceil(positions).astype(int)
+    if np.all(n == n[0]):  # same ranks on every row
+        kth = np.union1d(ranks_low[0], ranks_high[0])
+        data_sorted = np.partition(data, kth, axis=1)
+    else:
+        data_sorted = np.sort(data, axis=1)
+    values_low = np.take_along_axis(data_sorted, ranks_low, axis=1)
+    values_high = np.take_along_axis(data_sorted, ranks_high, axis=1)
+    values = values_low + (positions - ranks_low) * (values_high - values_low)
+
+    if has_nan:
+        data = np.where(mask, 0, data)
+    mean = data.sum(axis=1) / n
+    deviation = data - mean[:, None]
+    if has_nan:
+        deviation[mask] = 0
+    std = np.sqrt(np.einsum('ij,ij->i', deviation, deviation) / n)
+
+    stats_dict = {name: values[:, i] for i, name in enumerate(quantiles)}
+    stats_dict['mean'] = mean
+    stats_dict['std'] = std
+    if not stacked:
+        stats_dict = {name: value[0] for name, value in stats_dict.items()}
+
+    return stats_dict
+
+
+def get_standard_error(data, stat='percent_80'):
+    # Standard error of a buffer statistic. For the quantiles we use the
+    # distribution free 95% confidence interval given by the order statistics
+    # around the quantile, which does not need a density estimate
+    n = len(data)
+    if n < 2:
+        return np.inf
+
+    if stat == 'mean':
+        return np.std(data, ddof=1) / np.sqrt(n)
+
+    q = QUANTILES[stat]
+    half_width = 1.96 * np.sqrt(n * q * (1 - q))
+    k_low = max(int(np.floor(n * q - half_width)), 0)
+    k_high = min(int(np.ceil(n * q + half_width)), n - 1)
+    data_sorted = np.partition(data, [k_low, k_high])
+
+    return (data_sorted[k_high] - data_sorted[k_low]) / (2 * 1.96)
+
+
+def get_array_values(interface, channel_names, counts):
+    # Read only part of the array channels, counts maps channel -> number of
+    # elements, a negative count reads the tail. Interfaces that do not take
+    # counts read the arrays in full, and they are sliced here
+    try:
+        return interface.get_values(channel_names, counts=counts)
+    except TypeError:  # no counts keyword
+        pass
+
+    channel_outputs = interface.get_values(channel_names)
+    for channel, count in counts.items():
+        value = channel_outputs.get(channel)
+        if value is None or count is None:
+            continue
+        channel_outputs[channel] = value[count:] if count < 0 else \
+            value[:count]
+
+    return channel_outputs
+
+
+class SettleTimeModel:
+    # Settle time of each magnet against the size and direction of its steps,
+    # learned from the moves we watched. A censored sample is a move that had
+    # not settled yet after its settle time, when we stopped waiting
+
+    def __init__(self, min_samples=5, max_samples=100):
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        # (name, direction) -> [(step size, settle time, censored)]
+        self.history = {}
+
+    def record(self, name, step, settle_time, censored=False):
+        samples = self.history.setdefault((name, np.sign(step)), [])
+        samples.append((abs(step), settle_time, censored))
+        del samples[:-self.max_samples]
+
+    def predict(self, name, step):
+        # Return None if we don't know this magnet well enough yet
+        samples = self.history.get((name, np.sign(step)), [])
+        if sum(not censored for *_, censored in samples) < self.min_samples:
+            return None
+
+        steps, settle_times, censored = np.array(samples).T
+        censored = censored.astype(bool)
+        if abs(step) > steps.max():  # don't extrapolate
+            return None
+
+        # Settle time grows linearly with the step size, shifted up by the
+        # largest underestimate in the history to stay on the safe side. The
+        # censored moves count as if they had settled when we gave up
+        if np.ptp(steps) > 0:
+            coeffs = np.polyfit(steps, settle_times, 1)
+        else:
+            coeffs = [0, np.mean(settle_times)]
+        margin = np.max(settle_times - np.polyval(coeffs, steps))
+        prediction = max(np.polyval(coeffs, abs(step)) + margin, 0)
+
+        # The smaller steps that did not settle in time say it takes longer
+        if np.any(censored & (steps <= abs(step)) &
+                  (settle_times > prediction)):
+            return None
+
+        return prediction
+
+
+class FaultGate:
+    # Beam status kept up to date by the monitor updates of the fault PVs.
+    # beam_ok is set whenever is_ok holds for their latest values, so callers
+    # can check it right away, or wait on it while a fault is active. A fault
+    # PV that disconnects (None value) counts as a fault
+
+    def __init__(self, interface, channel_names, is_ok, as_string=True):
+        self.interface = interface
+        self.channel_names = list(channel_names)
+        self.is_ok = is_ok
+        self.values = {}
+        self.beam_ok = threading.Event()
+        self._lock = threading.Lock()
+        self._subscription = interface.subscribe(
+            self.channel_names, self._on_change, as_string=as_string)
+
+    @property
+    def connected(self):
+        # All the fault PVs are subscribed to and connected
+        with self._lock:
+            return self._subscription is not None and \
+                len(self.values) == len(self.channel_names) and \
+                None not in self.values.values()
+
+    def _on_change(self, channel, value):
+        with self._lock:
+            self.values[channel] = value
+            try:
+                ok = len(self.values) == len(self.channel_names) and \
+                    None not in self.values.values() and \
+                    self.is_ok(self.values)
+            except Exception:  # e.g. a value that cannot be parsed
+                ok = False
+
+            if ok:
+                self.beam_ok.set()
+            else:
+                self.beam_ok.clear()
+
+    def wait(self, timeout=None):
+        return self.beam_ok.wait(timeout)
+
+    def close(self):
+        if self._subscription is not None:
+            self.interface.unsubscribe(self._subscription)
+            self._subscription = None
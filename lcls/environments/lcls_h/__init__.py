@@ -1,14 +1,22 @@
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 from typing import Dict, List
 from badger import environment
-from badger.stats import percent_80
 from badger.errors import (
     BadgerEnvObsError,
     BadgerInterfaceChannelError,
     BadgerNoInterfaceError,
 )
 import logging
+from .utils import (
+    get_buffer_stats,
+    get_standard_error,
+    get_array_values,
+    SettleTimeModel,
+)
+
+PULSEID_MAX = 131040  # LCLS pulse IDs wrap around at this value
 
 
 class Environment(environment.Environment):
@@ -88,34 +96,107 @@ class Environment(environment.Environment):
     beamsize_monitor: str = "541"  # BPM channel for beam size
     loss_pv: str = "LBLM:COL0:862:A:I0_LOSSHSTSCS"  # PV name for loss monitor
 
+    bounds_ttl: float = 60.0  # in second, how long the cached bounds are valid
+
     use_check_var: bool = True  # if check var reaches the target value
     check_var_timeout: float = 100.0  # tumeout for the var check
     trim_delay: float = 3.0  # in second
+    start_timeout: float = 3.0  # in second, for the magnets to start moving
+    # Smallest tolerance on BACT w.r.t. the setpoint, in the magnet units. A
+    # magnet with a wider BDES/BACT deadband gets twice its deadband instead
+    settle_tolerance: float = 0.005
+    # Learn the settle time of each magnet against the size and direction of
+    # its steps. Without use_check_var, wait for the learned settle time
+    # instead of trim_delay once a magnet has settle_min_samples moves
+    learn_settle_time: bool = False
+    settle_min_samples: int = 5
     check_fault_timeout: float = 5.0  # in second
-    overshoot_fraction: float = 0.1
-
+    overshoot_fraction: float = 0.1  # the largest overshoot we allow
+    hysteresis_elements: List[str] = ["QUAD"]  # matched in the variable name
+    # Optional hysteresis model per element type, in fractions of the full
+    # range: going down by a step leaves a field error growing linearly with
+    # the step up to width, reached at a step of saturation. Coming back up
+    # from an overshoot removes overshoot / saturation of that error. The
+    # elements without a model always overshoot by overshoot_fraction
+    hysteresis_models: Dict = {}  # e.g. {"QUAD": {"width": ..., "saturation": ...}}
+    hysteresis_tolerance: float = 0.0  # field error we accept, same units
+
+    # Return as soon as enough new shots are in the buffers, instead of
+    # sleeping for points / rate
+    streaming: bool = False
+    pid_pv: str = "PATT:SYS0:1:PULSEID"  # pulse ID, buffer suffix is added
+    stream_timeout: float = 10.0  # in second
+    # Keep collecting shots until the relative standard error of the
+    # adaptive_stat ("percent_80", "mean" or "median") of the FEL intensity
+    # and of the beam loss is below adaptive_rel_error, or max_points is hit
+    adaptive: bool = False
+    adaptive_stat: str = "percent_80"
+    adaptive_rel_error: float = 0.01
+    max_points: int = 1200
+
+    # Attach the system states to each observation, as "system_states". They
+    # are read in the background while waiting for the beam
+    snapshot_states: bool = False
     epsilon: float = 1e-8  # avoid divided by zero in relative FEL jitter
 
+    # Private variables
+    _pid_last: float = None  # newest pulse ID seen before the next shots
+    _settle_model: SettleTimeModel = None
+    _bounds_cache: Dict = {}  # variable -> {"bounds": ..., "timestamp": ...}
+    _readbacks_start: Dict = {}  # variable -> BACT before the last move
+    _deadbands: Dict = {}  # variable -> largest BDES/BACT gap seen at rest
+    _states_executor: ThreadPoolExecutor = None  # reads the states snapshot
+
     def get_bounds(self, variable_names):
         if self.interface is None:
             raise BadgerNoInterfaceError
 
-        pvs_low = [v + ".DRVL" for v in variable_names]
-        pvs_high = [v + ".DRVH" for v in variable_names]
-        bounds_low = self.interface.get_values(pvs_low)
-        bounds_high = self.interface.get_values(pvs_high)
+        # Serve the bounds from the cache, read the missing and the expired
+        # ones in one go
+        time_now = time.time()
+        missing = []
+        for v in variable_names:
+            entry = self._bounds_cache.get(v)
+            if entry is None or time_now - entry["timestamp"] > self.bounds_ttl:
+                missing.append(v)
+
+        fallback_bounds = {}
+        if missing:
+            pvs_low = [v + ".DRVL" for v in missing]
+            pvs_high = [v + ".DRVH" for v in missing]
+            bounds = self.interface.get_values(pvs_low + pvs_high)
+
+            for i, v in enumerate(missing):
+                bound_low = bounds[pvs_low[i]]
+                bound_high = bounds[pvs_high[i]]
+                if bound_low is None or bound_high is None:
+                    # Don't cache the fallback, try again next time
+                    fallback_bounds[v] = [-1000, 1000]
+                    continue
+
+                self._bounds_cache[v] = {
+                    "bounds": [bound_low, bound_high],
+                    "timestamp": time_now,
+                }
 
         bound_outputs = {}
-        for i, v in enumerate(variable_names):
-            if bounds_low[pvs_low[i]] is None or bounds_high[pvs_high[i]] is None:
-                bounds_low[pvs_low[i]] = -1000
-                bounds_high[pvs_high[i]] = 1000
-
-            bound_outputs[v] = [bounds_low[pvs_low[i]], bounds_high[pvs_high[i]]]
+        for v in variable_names:
+            if v in fallback_bounds:
+                bound_outputs[v] = fallback_bounds[v]
+            else:
+                bound_outputs[v] = list(self._bounds_cache[v]["bounds"])
 
-        # bound_outputs["QUAD:IN20:525:BCTRL"] = [-10.0,10.0]
         return bound_outputs
 
+    def invalidate_bounds(self, variable_names=None):
+        # Drop the cached bounds of the given variables, or of all of them
+        if variable_names is None:
+            self._bounds_cache.clear()
+            return
+
+        for v in variable_names:
+            self._bounds_cache.pop(v, None)
+
     def get_variables(self, variable_names: List[str]) -> Dict:
         if self.interface is None:
             raise BadgerNoInterfaceError
@@ -150,107 +231,330 @@ class Environment(environment.Environment):
         if self.interface is None:
             raise BadgerNoInterfaceError
 
-        # prune variables that will not be changed
-        # variable_inputs = self.prune_nonchanging_variables(variable_inputs)
-
-        # implement hysteresis processes
-        # 1) ID which components are subject to hysteresis
-        # 2) for each component that has hysteresis do the following
-        #   - ID if its a unipolar or bipolar PS
-        #   - ID if we are going in the positive(negative) direction
-        #   - if positive -> set pv as normal
-        #   - if negative ->
-        #       - get total range of settings
-        #       - decrease setting beyond setpoint + 0.1*max_range
-        #       - set to final pv point
-
-        # if overshooting to mitigate hysteresis is active
+        # Only the shots taken after this move count for streaming
+        self._pid_last = None
+
+        # Magnets going down by more than their hysteresis allows are first
+        # taken below their setpoint and then brought up to it, so that they
+        # end on the same branch of the hysteresis loop
+        overshoot_values = {}
         if self.overshoot_fraction != 0.0:
-            hysteresis_elements = [
-                name for name in variable_inputs if self.is_hysteresis(name)
-            ]
+            overshoot_values = self.plan_overshoot(variable_inputs)
+
+        if not overshoot_values:
+            steps = self.get_steps(variable_inputs)
+            if self.use_check_var or self.learn_settle_time:
+                self.read_magnets(variable_inputs)
+            self.interface.set_values(variable_inputs)
+            self.check_variables(variable_inputs, steps)
+            return
 
-            # Early return if no hysteresis elements
-            if not hysteresis_elements:
-                self.interface.set_values(variable_inputs)
-                self.check_variables(variable_inputs)
-                return
-
-            # get the bounds for each
-            current_vals = self.interface.get_values(hysteresis_elements)
-            # print("current value",current_vals)
-            # print("variable inputs",hysteresis_elements)
-
-            # if we want to make negative changes then first overshoot in the
-            # negative direction
-            negative_changes = []
-            for name in hysteresis_elements:
-                if variable_inputs[name] < current_vals[name]:
-                    negative_changes.append(name)
-
-            # print(negative_changes)
-            if negative_changes:
-                # if there are any negative changes then overshoot in the neg direction
-                bounds = self._get_bounds(negative_changes)
-                overshoot_values = {
-                    name: np.clip(
-                        variable_inputs[name]
-                        - (bounds[name][1] - bounds[name][0]) * self.overshoot_fraction,
-                        bounds[name][0],
-                        bounds[name][1],
-                    )
-                    for name in negative_changes
-                }
+        # Pipeline the two legs: the other magnets go straight to their
+        # setpoints together with the overshoot leg, and we only wait for the
+        # overshooting magnets to reach the bottom before bringing them up
+        first_values = {**variable_inputs, **overshoot_values}
+        steps = self.get_steps(overshoot_values)
+        if self.use_check_var or self.learn_settle_time:
+            self.read_magnets(first_values)
+        self.interface.set_values(first_values)
+        self.check_variables(overshoot_values, steps)
+
+        final_values = {name: variable_inputs[name] for name in overshoot_values}
+        steps = self.get_steps(final_values)
+        if self.use_check_var or self.learn_settle_time:
+            self.read_magnets(final_values)
+        self.interface.set_values(final_values)
+        self.check_variables(variable_inputs, steps)
+
+    def plan_overshoot(self, variable_inputs: Dict[str, float]) -> Dict:
+        # Overshoot value of each hysteresis element that needs one
+        elements = [name for name in variable_inputs if self.is_hysteresis(name)]
+        if not elements:
+            return {}
+
+        current_vals = self.interface.get_values(elements)
+        negative_changes = [
+            name
+            for name in elements
+            if current_vals[name] is not None
+            and variable_inputs[name] < current_vals[name]
+        ]
+        if not negative_changes:
+            return {}
+
+        bounds = self.get_bounds(negative_changes)
+        overshoot_values = {}
+        for name in negative_changes:
+            low, high = bounds[name]
+            full_range = high - low
+            if full_range <= 0:
+                continue
+
+            step = (current_vals[name] - variable_inputs[name]) / full_range
+            overshoot = self.get_overshoot(self.get_element_type(name), step)
+            value = np.clip(variable_inputs[name] - overshoot * full_range, low, high)
+            if value < variable_inputs[name]:
+                overshoot_values[name] = value
+
+        return overshoot_values
+
+    def get_overshoot(self, element_type: str, step: float) -> float:
+        # Smallest overshoot (fraction of the full range) that brings the
+        # field error of a step down within hysteresis_tolerance, 0 if the
+        # step is small enough to go without
+        model = self.hysteresis_models.get(element_type)
+        if model is None:
+            return self.overshoot_fraction
+
+        error = model["width"] * min(step / model["saturation"], 1)
+        if error <= self.hysteresis_tolerance:
+            return 0.0
+
+        overshoot = model["saturation"] * (1 - self.hysteresis_tolerance / error)
+
+        return min(overshoot, self.overshoot_fraction)
+
+    def check_variables(self, variable_inputs, steps=None):
+        # If use_check_var is False, then we simply sleep for trim_delay,
+        # else, we check if the variables have reached the target values. See
+        # wait_for_trim for the learned settle time
+        if steps is None:
+            steps = {}
+
+        settled = self.wait_for_trim(variable_inputs, steps)
+        if self.use_check_var and not settled:
+            raise RuntimeWarning("check var timeout exceeded")
+
+    def get_steps(self, variable_inputs: Dict[str, float]) -> Dict:
+        # Step of each magnet in this move, only needed to learn settle times
+        names = [v for v in variable_inputs if v.endswith(":BCTRL")]
+        if not self.learn_settle_time or not names:
+            return {}
+
+        current_values = self.interface.get_values(names)
+
+        return {
+            name: variable_inputs[name] - current_values[name]
+            for name in names
+            if current_values[name] is not None
+        }
+
+    def get_settle_model(self) -> SettleTimeModel:
+        if self._settle_model is None:
+            self._settle_model = SettleTimeModel(self.settle_min_samples)
 
-                # set the overshoot values
-                # print("overshoot values",overshoot_values)
-                self.interface.set_values(overshoot_values)
-                self.check_variables(overshoot_values)
+        return self._settle_model
 
-        # set all variables
-        self.interface.set_values(variable_inputs)
-        self.check_variables(variable_inputs)
+    def record_settle_times(
+        self, steps: Dict, settle_times: Dict, timeout: float, offset: float = 0.0
+    ):
+        # The magnets missing from settle_times did not settle within
+        # timeout, we only know that they take longer. Those that had
+        # settled before we looked (None) tell us nothing
+        if not self.learn_settle_time:
+            return
 
-    def check_variables(self, variable_inputs):
-        # If use_check_var is False, then we simply sleep for trim_delay
-        # else, we check if the variables have reached the target values
+        model = self.get_settle_model()
+        for name, step in steps.items():
+            if name not in settle_times:
+                model.record(name, step, timeout, censored=True)
+            elif settle_times[name] is not None:
+                model.record(name, step, offset + settle_times[name])
+
+    def wait_for_trim(self, variable_inputs: Dict[str, float], steps: Dict) -> bool:
+        # Wait for the magnets after a move: until they have settled (up to
+        # check_var_timeout) with use_check_var, else for trim_delay. With
+        # learn_settle_time we watch them meanwhile to learn how long they
+        # take, and once the model knows all of them we sleep for their
+        # predicted settle time instead, then only check the readbacks as a
+        # guard. Return False if the magnets did not settle in time
+        if not self.learn_settle_time:
+            if self.use_check_var:
+                return self.wait_for_magnets(variable_inputs)
 
-        if not self.use_check_var:
             if self.trim_delay:
                 time.sleep(self.trim_delay)  # extra time for stablizing orbits
 
+            return True
+
+        if self.use_check_var:
+            timeout = self.check_var_timeout
+        else:
+            timeout = self.trim_delay
+        model = self.get_settle_model()
+        predictions = [model.predict(name, step) for name, step in steps.items()]
+
+        time_start = time.time()
+        settle_times = {}
+        if not predictions or None in predictions:
+            settled = self.wait_for_magnets(
+                variable_inputs, timeout=timeout, settle_times=settle_times
+            )
+            self.record_settle_times(steps, settle_times, timeout)
+            if not self.use_check_var:  # keep the usual delay while learning
+                time.sleep(max(timeout - (time.time() - time_start), 0))
+
+            return settled
+
+        wait = max(predictions)
+        logging.info(f"Predicted settle time: {wait:.2f} s")
+        time.sleep(min(wait, timeout))
+
+        settled = self.wait_for_magnets(
+            variable_inputs,
+            timeout=max(timeout - wait, 0),
+            settle_times=settle_times,
+            wait_start=False,
+        )
+        self.record_settle_times(steps, settle_times, max(timeout, wait), offset=wait)
+
+        return settled
+
+    def get_magnets(self, variable_inputs: Dict[str, float]) -> Dict:
+        # variable -> magnet device, for the BCTRL variables
+        return {v: v[: v.rfind(":")] for v in variable_inputs if v.endswith(":BCTRL")}
+
+    def read_magnets(self, variable_inputs: Dict[str, float]):
+        # Take the readback of the magnets right before moving them, to see
+        # when they start moving. The BDES/BACT gap of a magnet at rest tells
+        # us its deadband, i.e. how close to the setpoint it will settle
+        magnets = self.get_magnets(variable_inputs)
+        if not magnets:
             return
 
-        variable_ready_flags = [
-            v[: v.rfind(":")] + ":STATCTRLSUB.T"
-            for v in variable_inputs
-            if v.endswith(":BCTRL")
-        ]
+        channel_names = []
+        for magnet in magnets.values():
+            channel_names += [
+                f"{magnet}:STATCTRLSUB.T",
+                f"{magnet}:BDES",
+                f"{magnet}:BACT",
+            ]
+        values = self.interface.get_values(channel_names)
+
+        for name, magnet in magnets.items():
+            flag = values[f"{magnet}:STATCTRLSUB.T"]
+            setpoint = values[f"{magnet}:BDES"]
+            readback = values[f"{magnet}:BACT"]
+            self._readbacks_start[name] = readback
+            if flag is None or flag or setpoint is None or readback is None:
+                continue  # not at rest
+
+            self._deadbands[name] = max(
+                self._deadbands.get(name, 0), abs(setpoint - readback)
+            )
+
+    def get_settle_tolerance(self, variable_name: str) -> float:
+        deadband = self._deadbands.get(variable_name, 0)
+
+        return max(2 * deadband, self.settle_tolerance)
+
+    def wait_for_magnets(
+        self,
+        variable_inputs: Dict[str, float],
+        timeout: float = None,
+        settle_times: Dict = None,
+        wait_start: bool = True,
+    ) -> bool:
+        # Wait (up to start_timeout) for the magnets to start moving, i.e.
+        # for their ready flag to be set or their BACT readback to leave its
+        # value before the move. A magnet has then settled once its flag is
+        # cleared and its readback is within its settle tolerance of the
+        # setpoint. Return False if the magnets did not settle within timeout
+        # (check_var_timeout by default). The time each magnet took since
+        # the call goes into settle_times, None if it had already settled
+        # when we first looked
+        if timeout is None:
+            timeout = self.check_var_timeout
+
+        magnets = self.get_magnets(variable_inputs)
+        if not magnets:
+            return True
 
-        # variable_status = self.interface.get_values(variable_ready_flags)
+        channel_names = []
+        for magnet in magnets.values():
+            channel_names += [f"{magnet}:STATCTRLSUB.T", f"{magnet}:BACT"]
+
+        tolerances = {name: self.get_settle_tolerance(name) for name in magnets}
+        readbacks_start = {name: self._readbacks_start.get(name) for name in magnets}
+
+        # Steps within the tolerance may not move the magnet at all
+        if wait_start:
+            started = {
+                name
+                for name, start in readbacks_start.items()
+                if start is not None
+                and abs(variable_inputs[name] - start) <= tolerances[name]
+            }
+        else:
+            started = set(magnets)
+        moving = set(magnets) - started
 
-        # wait for magnets to start changing
-        # while not np.any(np.array(list(variable_status.values()))):
-        # time.sleep(0.1)
-        # variable_status = self.interface.get_values(variable_ready_flags)
+        time_start = time.time()
 
-        time.sleep(3.0)
+        def is_started(values):
+            for name, magnet in magnets.items():
+                flag = values[f"{magnet}:STATCTRLSUB.T"]
+                readback = values[f"{magnet}:BACT"]
+                start = readbacks_start[name]
+                if flag or (
+                    readback is not None
+                    and start is not None
+                    and abs(readback - start) > tolerances[name]
+                ):
+                    started.add(name)
+                    moving.add(name)
+
+            return len(started) == len(magnets)
+
+        def is_settled(values):
+            settled = True
+            for name, magnet in magnets.items():
+                flag = values[f"{magnet}:STATCTRLSUB.T"]
+                readback = values[f"{magnet}:BACT"]
+                if (
+                    flag is None
+                    or flag
+                    or readback is None
+                    or abs(readback - variable_inputs[name]) > tolerances[name]
+                ):
+                    settled = False
+                    moving.add(name)
+                elif settle_times is not None and name not in settle_times:
+                    settle_times[name] = (
+                        time.time() - time_start if name in moving else None
+                    )
 
-        # print(variable_ready_flags)
-        variable_status = self.interface.get_values(variable_ready_flags)
-        # print(variable_status)
+            return settled
+
+        if len(started) < len(magnets):
+            if not self.wait_for_channels(
+                channel_names, is_started, self.start_timeout
+            ):
+                logging.debug(
+                    "Magnets did not start moving in "
+                    f"{self.start_timeout} s: "
+                    f"{sorted(set(magnets) - started)}"
+                )
+
+        return self.wait_for_channels(channel_names, is_settled, timeout)
+
+    def wait_for_channels(
+        self, channel_names: List[str], condition, timeout: float
+    ) -> bool:
+        # Let the interface wake us up on the monitor updates if it can
+        if hasattr(self.interface, "wait_for_values"):
+            return self.interface.wait_for_values(
+                channel_names, condition, timeout=timeout
+            )
 
         time_start = time.time()
-        while np.any(np.array(list(variable_status.values()))):
+        while not condition(self.interface.get_values(channel_names)):
+            if time.time() - time_start > timeout:
+                return False
+
             time.sleep(0.1)
 
-            variable_status = self.interface.get_values(variable_ready_flags)
-            # print(variable_status)
-
-            time_elapsed = time.time() - time_start
-            if time_elapsed > self.check_var_timeout:
-                raise RuntimeWarning("check var timeout exceeded")
-                break
+        return True
 
     def prune_nonchanging_variables(self, variable_inputs):
         current_vals = self.interface.get_values(list(variable_inputs.keys()))
@@ -261,11 +565,15 @@ class Environment(environment.Environment):
         print("final variable inputs", variable_inputs)
         return variable_inputs
 
-    def is_hysteresis(self, variable_name: str) -> bool:
-        if "QUAD" in variable_name:
-            return True
+    def get_element_type(self, variable_name: str) -> str:
+        for element_type in self.hysteresis_elements:
+            if element_type in variable_name:
+                return element_type
+
+        return None
 
-        return False
+    def is_hysteresis(self, variable_name: str) -> bool:
+        return self.get_element_type(variable_name) is not None
 
     def get_intensity_n_loss(self):
         # At lcls the repetition is 120 Hz and the readout buf size is 2800.
@@ -275,6 +583,9 @@ class Environment(environment.Environment):
         points = self.points
         logging.info(f"Get value of {points} points")
 
+        if self.streaming or self.adaptive:
+            return self.stream_intensity_n_loss()
+
         # Sleep for a while to get enough data
         try:
             rate = self.interface.get_value("EVNT:SYS0:1:LCLSBEAMRATE")
@@ -295,19 +606,139 @@ class Environment(environment.Environment):
             PV_gas = "EM1K0:GMD:HPS:milliJoulesPerPulseHSTCUSBR"
         PV_loss = self.loss_pv
         try:
-            results_dict = self.interface.get_values([PV_gas, PV_loss])
+            # Only fetch the tails of the buffers
+            results_dict = get_array_values(
+                self.interface, [PV_gas, PV_loss], {PV_gas: -points, PV_loss: -points}
+            )
             intensity_raw = results_dict[PV_gas][-points:]
             loss_raw = results_dict[PV_loss][-points:]
             ind_valid = ~np.logical_or(np.isnan(intensity_raw), np.isnan(loss_raw))
             intensity_valid = intensity_raw[ind_valid]
             loss_valid = loss_raw[ind_valid]
 
-            gas_p80 = percent_80(intensity_valid)
-            gas_mean = np.mean(intensity_valid)
-            gas_median = np.median(intensity_valid)
-            gas_std = np.std(intensity_valid)
+            # Stats of both buffers in one pass
+            stats = get_buffer_stats([intensity_valid, loss_valid])
+            gas_p80, loss_p80 = stats["percent_80"]
+            gas_mean = stats["mean"][0]
+            gas_median = stats["median"][0]
+            gas_std = stats["std"][0]
 
-            loss_p80 = percent_80(loss_valid)
+            return gas_p80, gas_mean, gas_median, gas_std, loss_p80
+        except Exception:  # if average fails use the scalar input
+            if hxr:  # we don't have scalar input for HXR
+                raise BadgerEnvObsError
+            else:
+                gas = self.interface.get_value("EM1K0:GMD:HPS:milliJoulesPerPulse")
+
+                return gas, gas, gas, 0, 0
+
+    def stream_buffers(self, pvs, is_enough):
+        # Follow the newest entries of the buffers, only keep the shots with
+        # a pulse ID newer than the last one we have seen (and valid in all
+        # the buffers), until is_enough(shots) says we can stop. The
+        # reference pulse ID is reset by set_variables, so the first read
+        # only sets it
+        try:
+            rate = self.interface.get_value("EVNT:SYS0:1:LCLSBEAMRATE")
+            logging.info(f"Beam rate: {rate}")
+            rate = float(rate) or 120.0
+        except Exception:
+            rate = 120.0
+
+        if self.hxr:
+            PV_pid = f"{self.pid_pv}HSTCUHBR"
+        else:  # SXR
+            PV_pid = f"{self.pid_pv}HSTCUSBR"
+        # Leave some margin in case the buffers move on between two reads
+        window = 2 * self.points
+        counts = {pv: -window for pv in pvs + [PV_pid]}
+
+        shots = {pv: np.empty(0) for pv in pvs}
+        time_start = time.time()
+        while True:
+            results_dict = get_array_values(self.interface, pvs + [PV_pid], counts)
+            pid_raw = results_dict[PV_pid]
+
+            if self._pid_last is None:
+                self._pid_last = pid_raw[~np.isnan(pid_raw)][-1]
+            else:
+                # Pulse IDs wrap around, compare them modulo PULSEID_MAX
+                pid_diff = (pid_raw - self._pid_last) % PULSEID_MAX
+                ind_valid = (pid_diff > 0) & (pid_diff < PULSEID_MAX / 2)
+                if np.any(ind_valid):
+                    self._pid_last = pid_raw[ind_valid][-1]
+
+                for pv in pvs:
+                    ind_valid &= ~np.isnan(results_dict[pv])
+                for pv in pvs:
+                    shots[pv] = np.concatenate([shots[pv], results_dict[pv][ind_valid]])
+
+            n_shots = len(shots[pvs[0]])
+            if n_shots and is_enough(shots):
+                break
+
+            if time.time() - time_start > self.stream_timeout:
+                logging.warn(
+                    f"Only got {n_shots} new points in {self.stream_timeout} s"
+                )
+                break
+
+            # Wait for roughly the missing number of shots, adaptive
+            # acquisition keeps going in small chunks
+            n_missing = max(self.points - n_shots, self.points // 10, 1)
+            time.sleep(n_missing / rate)
+
+        return shots
+
+    def has_enough_shots(self, *buffers):
+        # Without adaptive acquisition we simply want points shots, else
+        # we keep going until the requested statistic of every buffer is
+        # known well enough, or we hit max_points
+        n_shots = len(buffers[0])
+        if n_shots < self.points:
+            return False
+
+        if not self.adaptive or n_shots >= self.max_points:
+            return True
+
+        values = get_buffer_stats(buffers)[self.adaptive_stat]
+        for data, value in zip(buffers, values):
+            error = get_standard_error(data, self.adaptive_stat)
+            if error > self.adaptive_rel_error * (abs(value) + self.epsilon):
+                return False
+
+        return True
+
+    def stream_intensity_n_loss(self):
+        hxr = self.hxr
+        points = self.points
+
+        if hxr:
+            PV_gas = f"GDET:FEE1:{self.fel_channel}:ENRCHSTCUHBR"
+        else:  # SXR
+            PV_gas = "EM1K0:GMD:HPS:milliJoulesPerPulseHSTCUSBR"
+        PV_loss = self.loss_pv
+
+        try:
+            shots = self.stream_buffers(
+                [PV_gas, PV_loss],
+                lambda shots: self.has_enough_shots(shots[PV_gas], shots[PV_loss]),
+            )
+            # Adaptive acquisition uses all the shots, else the newest points
+            if self.adaptive:
+                intensity_valid = shots[PV_gas]
+                loss_valid = shots[PV_loss]
+            else:
+                intensity_valid = shots[PV_gas][-points:]
+                loss_valid = shots[PV_loss][-points:]
+            logging.info(f"Valid point number: {len(intensity_valid)}")
+
+            # Stats of both buffers in one pass
+            stats = get_buffer_stats([intensity_valid, loss_valid])
+            gas_p80, loss_p80 = stats["percent_80"]
+            gas_mean = stats["mean"][0]
+            gas_median = stats["median"][0]
+            gas_std = stats["std"][0]
 
             return gas_p80, gas_mean, gas_median, gas_std, loss_p80
         except Exception:  # if average fails use the scalar input
@@ -318,10 +749,30 @@ class Environment(environment.Environment):
 
                 return gas, gas, gas, 0, 0
 
+    def stream_loss(self):
+        PV_loss = self.loss_pv
+
+        try:
+            shots = self.stream_buffers(
+                [PV_loss], lambda shots: self.has_enough_shots(shots[PV_loss])
+            )
+            if self.adaptive:
+                loss_valid = shots[PV_loss]
+            else:
+                loss_valid = shots[PV_loss][-self.points :]
+            loss_p80 = get_buffer_stats(loss_valid)["percent_80"]
+
+            return loss_p80
+        except Exception:  # we don't have scalar input for loss
+            raise BadgerEnvObsError
+
     def get_loss(self):  # if only loss is observed
         points = self.points
         logging.info(f"Get value of {points} points")
 
+        if self.streaming or self.adaptive:
+            return self.stream_loss()
+
         try:
             rate = self.interface.get_value("EVNT:SYS0:1:LCLSBEAMRATE")
             logging.info(f"Beam rate: {rate}")
@@ -337,10 +788,13 @@ class Environment(environment.Environment):
 
         PV_loss = self.loss_pv
         try:
-            loss_raw = self.interface.get_value(PV_loss)[-points:]
+            results_dict = get_array_values(
+                self.interface, [PV_loss], {PV_loss: -points}
+            )
+            loss_raw = results_dict[PV_loss][-points:]
             ind_valid = ~np.isnan(loss_raw)
             loss_valid = loss_raw[ind_valid]
-            loss_p80 = percent_80(loss_valid)
+            loss_p80 = get_buffer_stats(loss_valid)["percent_80"]
 
             return loss_p80
         except Exception:  # we don't have scalar input for loss
@@ -354,6 +808,27 @@ class Environment(environment.Environment):
     def is_beam_loss_observed(self, observable_names):
         return "beam_loss" in observable_names
 
+    def get_observable_registry(self):
+        # Observable name -> (PVs it needs, how to compute it from their values)
+        mid = self.beamsize_monitor
+        PV_bs_x = f"OTRS:IN20:{mid}:XRMS"
+        PV_bs_y = f"OTRS:IN20:{mid}:YRMS"
+
+        return {
+            "energy": (["BEND:DMPH:400:BDES"], lambda energy: energy),
+            "charge": (["SIOC:SYS0:ML00:CALC252"], lambda charge: charge),
+            "current": (["BLEN:LI24:886:BIMAX"], lambda current: current),
+            "beamrate": (["EVNT:SYS0:1:LCLSBEAMRATE"], lambda rate: rate),
+            "beamsize_x": ([PV_bs_x], lambda bs_x: bs_x),
+            "beamsize_y": ([PV_bs_y], lambda bs_y: bs_y),
+            "beamsize_r": (
+                [PV_bs_x, PV_bs_y],
+                lambda bs_x, bs_y: np.linalg.norm([bs_x, bs_y]),
+            ),
+            "beamsize_g": ([PV_bs_x, PV_bs_y], lambda bs_x, bs_y: np.sqrt(bs_x * bs_y)),
+            "pulse_id": (["PATT:SYS0:1:PULSEID"], lambda pid: pid),
+        }
+
     def get_observables(self, observable_names: List[str]) -> Dict:
         assert self.interface, "Must provide an interface!"
 
@@ -363,6 +838,11 @@ class Environment(environment.Environment):
         observe_gas = self.is_pulse_intensity_observed(observable_names)
         observe_loss = self.is_beam_loss_observed(observable_names)
 
+        take_snapshot = self.snapshot_states and (observe_gas or observe_loss)
+        states_future = None
+        if take_snapshot:
+            states_future = self.start_states_snapshot()
+
         if observe_gas:
             intensity_p80, intensity_mean, intensity_median, intensity_std, loss_p80 = (
                 self.get_intensity_n_loss()
@@ -370,29 +850,20 @@ class Environment(environment.Environment):
         elif observe_loss:
             loss_p80 = self.get_loss()
 
+        # Read the PVs of all the requested scalar observables in one go,
+        # each PV only once, so that they all come from the same instant
+        registry = self.get_observable_registry()
+        pvs = [
+            pv for obs in observable_names if obs in registry for pv in registry[obs][0]
+        ]
+        pvs = list(dict.fromkeys(pvs))
+        values = self.interface.get_values(pvs) if pvs else {}
+
         observable_outputs = {}
-        mid = self.beamsize_monitor
         for obs in observable_names:
-            if obs == "energy":
-                value = self.interface.get_value("BEND:DMPH:400:BDES")
-            elif obs == "charge":
-                value = self.interface.get_value("SIOC:SYS0:ML00:CALC252")
-            elif obs == "current":
-                value = self.interface.get_value("BLEN:LI24:886:BIMAX")
-            elif obs == "beamrate":
-                value = self.interface.get_value("EVNT:SYS0:1:LCLSBEAMRATE")
-            elif obs == "beamsize_x":
-                value = self.interface.get_value(f"OTRS:IN20:{mid}:XRMS")
-            elif obs == "beamsize_y":
-                value = self.interface.get_value(f"OTRS:IN20:{mid}:YRMS")
-            elif obs == "beamsize_r":
-                bs_x = self.interface.get_value(f"OTRS:IN20:{mid}:XRMS")
-                bs_y = self.interface.get_value(f"OTRS:IN20:{mid}:YRMS")
-                value = np.linalg.norm([bs_x, bs_y])
-            elif obs == "beamsize_g":
-                bs_x = self.interface.get_value(f"OTRS:IN20:{mid}:XRMS")
-                bs_y = self.interface.get_value(f"OTRS:IN20:{mid}:YRMS")
-                value = np.sqrt(bs_x * bs_y)
+            if obs in registry:
+                obs_pvs, compute = registry[obs]
+                value = compute(*[values[pv] for pv in obs_pvs])
             elif obs == "beam_loss":
                 value = loss_p80
             elif obs == "pulse_intensity_p80":
@@ -405,13 +876,18 @@ class Environment(environment.Environment):
                 value = intensity_std
             elif obs == "pulse_intensity_std_relative":
                 value = intensity_std / (intensity_mean + self.epsilon)
-            elif obs == "pulse_id":
-                value = self.interface.get_value("PATT:SYS0:1:PULSEID")
             else:  # won't happen actually
                 value = None
 
             observable_outputs[obs] = value
 
+        if take_snapshot:
+            if states_future is not None:
+                system_states = states_future.result()
+            else:
+                system_states = self.get_system_states()
+            observable_outputs["system_states"] = system_states
+
         return observable_outputs
 
     def check_fault_status(self):
@@ -434,6 +910,19 @@ class Environment(environment.Environment):
 
                 time.sleep(0.1 * np.random.rand())
 
+    def start_states_snapshot(self) -> Future:
+        # Read the system states on a background thread, so that they are
+        # read while we wait for the beam shots instead of after them. Return
+        # None if the interface cannot be shared with another thread: a non
+        # persistent epics_raw clears the channels after each call
+        if not getattr(self.interface, "persistent", True):
+            return None
+
+        if self._states_executor is None:
+            self._states_executor = ThreadPoolExecutor(max_workers=1)
+
+        return self._states_executor.submit(self.get_system_states)
+
     def get_system_states(self):
         if self.interface is None:
             raise BadgerNoInterfaceError
@@ -507,9 +996,10 @@ class Environment(environment.Environment):
         ]
 
         try:
-            states_general = self.interface.get_values(general_pvs)
-            states_quads = self.interface.get_values(matching_quads)
-            states_extra = self.interface.get_values(extra_pvs)
+            states = self.interface.get_values(general_pvs + matching_quads + extra_pvs)
+            states_general = {pv: states[pv] for pv in general_pvs}
+            states_quads = {pv: states[pv] for pv in matching_quads}
+            states_extra = {pv: states[pv] for pv in extra_pvs}
 
             system_states = {
                 "HXR electron energy [GeV]": states_general["BEND:DMPH:400:BDES"],
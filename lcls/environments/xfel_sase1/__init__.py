@@ -1,8 +1,11 @@
 import time
 import numpy as np
 from badger import environment
+from badger.errors import BadgerEnvObsError
 from badger.interface import Interface
 
+A1_AMPLITUDE = "XFEL.RF/LLRF.CONTROLLER/CTRL.A1.I1/SP.AMPL"
+
 
 class Environment(environment.Environment):
 
@@ -11,6 +14,9 @@ class Environment(environment.Environment):
     def __init__(self, interface: Interface, params):
         super().__init__(interface, params)
 
+        self._setpoints = {}  # variable -> last value set
+        self._disp_reference = None  # (optics key, reference orbit)
+
     limits_undulators = {
         'XFEL.FEL/UNDULATOR.SASE1/CAX.CELL10.SA1/FIELD.OFFSET': [-0.5, 0.5],
         'XFEL.FEL/UNDULATOR.SASE1/CAX.CELL11.SA1/FIELD.OFFSET': [-0.5, 0.5],
@@ -169,138 +175,168 @@ class Environment(environment.Environment):
 
     def _set_var(self, var, x):
         self.interface.set_value(var, x)
+        self._setpoints[var] = x
+
+    # Channels read by each observable, and over how many trains they are
+    # averaged. target_disp moves the machine and is measured on its own
+    obs_channels = {
+        'charge': ['XFEL.DIAG/CHARGE.ML/TORA.25.I1/CHARGE.SA1'],
+        'sases': ['XFEL.FEL/XGM/XGM.2595.T6/INTENSITY.RAW.TRAIN'],
+        'sases_average': ['XFEL.FEL/XGM/XGM.2643.T9/INTENSITY.SA1.RAW.TRAIN'],
+        'beam_energy': [
+            'XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/TLD/ENERGY.DUD',
+            'XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/T4D/ENERGY.SA1',
+            'XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/T5D/ENERGY.SA2',
+        ],
+        'wavelength': [
+            'XFEL.FEL/XGM.PHOTONFLUX/XGM.2643.T9/WAVELENGTH',
+            'XFEL.FEL/XGM.PHOTONFLUX/XGM.2595.T6/WAVELENGTH',
+            'XFEL.FEL/XGM.PHOTONFLUX/XGM.3130.T10/WAVELENGTH',
+        ],
+        'ref_sase_signal': [
+            'XFEL.FEL/XGM/XGM.2643.T9/INTENSITY.SA1.SLOW.TRAIN',
+            'XFEL.FEL/XGM/XGM.2595.T6/INTENSITY.SLOW.TRAIN',
+        ],
+        'target_sase': [
+            'XFEL.DIAG/BPM/BPME.2252.SA2/X.ALL',
+            'XFEL.DIAG/BPM/BPME.2258.SA2/X.ALL',
+            'XFEL.DIAG/BPM/BPME.2264.SA2/X.ALL',
+        ],
+    }
+    obs_n_trains = {
+        'sases_average': 30,
+        'target_sase': 7,
+    }
 
     def _get_obs(self, obs):
+        return self.get_obses([obs])[0]
+
+    def get_obses(self, obses):
+        # Wait once after the move, then read the channels of all the
+        # observables together, over as many trains as the most averaged
+        # one needs
         try:
             dt = self.params['waiting_time']
         except KeyError:
             dt = 0
         time.sleep(dt)
 
+        channels = []
+        n_trains = 0
+        for obs in obses:
+            if obs not in self.obs_channels:
+                continue
+            channels += [c for c in self.obs_channels[obs] if c not in channels]
+            n_trains = max(n_trains, self.obs_n_trains.get(obs, 1))
+
+        readings = {}
+        if channels:
+            rows = self.interface.get_train_values(channels, n_trains)
+            readings = {channel: rows[:, i] for i, channel in
+                        enumerate(channels)}
+
+        return [self._compute_obs(obs, readings) for obs in obses]
+
+    def get_obses_dict(self):
+        obses = self.list_obses()
+        return dict(zip(obses, self.get_obses(obses)))
+
+    def _compute_obs(self, obs, readings):
+        if obs == 'target_disp':
+            return self.get_target_disp()
+
+        # Readings of the observable channels, first train first
+        n_trains = self.obs_n_trains.get(obs, 1)
+        values = [readings[channel][:n_trains] for channel in
+                  self.obs_channels[obs]]
+
+        def first(data):
+            # A NaN reading is reported as None
+            if np.isnan(data[0]):
+                return None
+            return data[0]
 
         if obs == 'charge':
-            return self.interface.get_value('XFEL.DIAG/CHARGE.ML/TORA.25.I1/CHARGE.SA1')
+            return first(values[0])
         elif obs == 'sases':
-            try:
-                sa = self.interface.get_value(
-                    "XFEL.FEL/XGM/XGM.2595.T6/INTENSITY.RAW.TRAIN")
-            except:
-                sa = None
-
-            time.sleep(0.1)
-            print(f"return values is: {sa}")        
+            sa = first(values[0])
+            print(f"return values is: {sa}")
             return sa
-
         elif obs == 'sases_average':
-            values = []
-            for i in range(30):
-                sa1 = self.interface.get_value(
-                    "XFEL.FEL/XGM/XGM.2643.T9/INTENSITY.SA1.RAW.TRAIN")
-                values.append(sa1)
-                time.sleep(0.1)
-            return np.mean(values)
-
-        elif obs == 'beam_energy':
-            try:
-                tld = self.interface.get_value(
-                    "XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/TLD/ENERGY.DUD")
-            except:
-                tld = None
-            #t3 = self.interface.get_value("XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/T3/ENERGY.SA2")
-            #t4 = self.interface.get_value("XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/T4/ENERGY.SA1")
-            #t5 = self.interface.get_value("XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/T5/ENERGY.SA2")
-            try:
-                t4d = self.interface.get_value(
-                    "XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/T4D/ENERGY.SA1")
-            except:
-                t4d = None
-            try:
-                t5d = self.interface.get_value(
-                    "XFEL.DIAG/BEAM_ENERGY_MEASUREMENT/T5D/ENERGY.SA2")          
-            except:
-                t5d = None
-            return [tld, t4d, t5d]
-        elif obs == 'wavelength':
-            try:
-                sa1 = self.interface.get_value(
-                    "XFEL.FEL/XGM.PHOTONFLUX/XGM.2643.T9/WAVELENGTH")
-            except:
-                sa1 = None
-            try:
-                sa2 = self.interface.get_value(
-                    "XFEL.FEL/XGM.PHOTONFLUX/XGM.2595.T6/WAVELENGTH")
-            except:
-                sa2 = None
-            try:
-                sa3 = self.interface.get_value(
-                    "XFEL.FEL/XGM.PHOTONFLUX/XGM.3130.T10/WAVELENGTH")
-            except:
-                sa3 = None
-            return [sa1, sa2, sa3]
-        elif obs == 'ref_sase_signal':
-            try:
-                sa1 = self.interface.get_value(
-                    "XFEL.FEL/XGM/XGM.2643.T9/INTENSITY.SA1.SLOW.TRAIN")
-            except:
-                sa1 = None
-            try:
-                sa2 = self.interface.get_value(
-                    "XFEL.FEL/XGM/XGM.2595.T6/INTENSITY.SLOW.TRAIN")
-            except:
-                sa2 = None
-            # try:
-            #    sa3 = self.interface.get_value("XFEL.FEL/XGM.PHOTONFLUX/XGM.3130.T10/WAVELENGTH")
-            # except:
-            #    sa3 = None
-            return [sa1, sa2]
+            return np.mean(values[0])
+        elif obs in ['beam_energy', 'wavelength', 'ref_sase_signal']:
+            return [first(data) for data in values]
         elif obs == 'target_sase':
-            bpms = [
-                "XFEL.DIAG/BPM/BPME.2252.SA2/X.ALL",
-                "XFEL.DIAG/BPM/BPME.2258.SA2/X.ALL",
-                "XFEL.DIAG/BPM/BPME.2264.SA2/X.ALL",
-            ]
-
-            orbit1 = self.read_bpms(bpms=bpms, nreadings=7)
-            orbit2 = np.zeros(len(bpms))  # just [0, 0, 0, ... ]
+            orbit1 = np.mean(np.array(values), axis=1)
+            orbit2 = np.zeros(len(orbit1))  # just [0, 0, 0, ... ]
             target = np.sqrt(np.sum((orbit2 - orbit1) ** 2))
 
             return target
-        elif obs == "target_disp":
-            bpms = ["XFEL.DIAG/BPM/BPMA.59.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.72.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.75.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.77.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.80.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.82.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.85.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.87.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.90.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.92.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMF.95.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMC.134.L1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.117.I1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMC.158.L1/X.ALL",
-                    "XFEL.DIAG/BPM/BPMA.179.B1/X.ALL"]
-            Vinit = self.interface.get_value("XFEL.RF/LLRF.CONTROLLER/CTRL.A1.I1/SP.AMPL")
-            orbit1 = self.read_bpms(bpms=bpms, nreadings=7)
-
-            time.sleep(0.1)
-            self.interface.set_value("XFEL.RF/LLRF.CONTROLLER/CTRL.A1.I1/SP.AMPL", Vinit - 2)
-            time.sleep(0.9)
 
-            orbit2 = self.read_bpms(bpms=bpms, nreadings=7)
+    disp_bpms = [
+        "XFEL.DIAG/BPM/BPMA.59.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.72.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.75.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.77.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.80.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.82.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.85.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.87.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.90.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.92.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMF.95.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMC.134.L1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.117.I1/X.ALL",
+        "XFEL.DIAG/BPM/BPMC.158.L1/X.ALL",
+        "XFEL.DIAG/BPM/BPMA.179.B1/X.ALL",
+    ]
+
+    # Sections of the dispersion BPMs, only the variables in there change
+    # the orbit they see (the undulators are further down)
+    disp_sections = ['I1', 'I1D', 'L1', 'B1']
+
+    def get_disp_key(self, Vinit):
+        # The settings the reference orbit depends on: the A1 amplitude and
+        # the variables set in the dispersion BPM sections, e.g.
+        # XFEL.MAGNETS/MAGNET.ML/CIX.90.I1/KICK_MRAD.SP is in I1
+        setpoints = tuple(sorted(
+            (var, x) for var, x in self._setpoints.items()
+            if var.split('/')[-2].rsplit('.', 1)[-1] in self.disp_sections))
+
+        return Vinit, setpoints
+
+    def get_target_disp(self):
+        # Orbit change over disp_bpms when the A1 amplitude is lowered by 2.
+        # The reference orbit is reused while the settings it depends on
+        # stay the same. The amplitude is restored even if a read fails, and
+        # settles while the target is computed
+        Vinit = self.interface.get_value(A1_AMPLITUDE)
+        if Vinit is None or np.isnan(Vinit):
+            raise BadgerEnvObsError(f'{A1_AMPLITUDE} readout is invalid')
 
-            self.interface.set_value("XFEL.RF/LLRF.CONTROLLER/CTRL.A1.I1/SP.AMPL", Vinit)
+        key = self.get_disp_key(Vinit)
+        if self._disp_reference is None or self._disp_reference[0] != key:
+            orbit1 = self.interface.get_train_values(self.disp_bpms, 7,
+                                                     aligned=True)
+            self._disp_reference = (key, np.mean(orbit1, axis=0))
+        orbit1 = self._disp_reference[1]
+
+        self.interface.set_value(A1_AMPLITUDE, Vinit - 2)
+        try:
             time.sleep(0.9)
+            orbit2 = self.interface.get_train_values(self.disp_bpms, 7,
+                                                     aligned=True)
+        finally:
+            self.interface.set_value(A1_AMPLITUDE, Vinit)
+            t_restore = time.time()
 
-            target = -np.sqrt(np.sum((orbit2 - orbit1)**2))
-            return target
+        target = -np.sqrt(np.sum((np.mean(orbit2, axis=0) - orbit1)**2))
+
+        # Return only once the amplitude is back and settled
+        time.sleep(max(0.9 - (time.time() - t_restore), 0))
+
+        return target
 
     def read_bpms(self, bpms, nreadings):
-        orbits = np.zeros((nreadings, len(bpms)))
-        for i in range(nreadings):
-            for j, bpm in enumerate(bpms):
-                orbits[i, j] = self.interface.get_value(bpm)
-            time.sleep(0.1)
+        orbits = self.interface.get_train_values(bpms, nreadings)
         return np.mean(orbits, axis=0)
-
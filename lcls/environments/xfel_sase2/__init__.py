@@ -170,28 +170,57 @@ class Environment(environment.Environment):
     def _set_var(self, var, x):
         self.interface.set_value(var, x)
 
+    # Channels read by each observable, and over how many trains they are
+    # averaged
+    obs_channels = {
+        'sases_average': ['XFEL.FEL/XGM/XGM.2595.T6/INTENSITY.RAW.TRAIN'],
+    }
+    obs_n_trains = {
+        'sases_average': 30,
+    }
+
     def _get_obs(self, obs):
+        return self.get_obses([obs])[0]
+
+    def get_obses(self, obses):
+        # Wait once after the move, then read the channels of all the
+        # observables together, over as many trains as the most averaged
+        # one needs
         try:
             dt = self.params['waiting_time']
         except KeyError:
             dt = 0
         time.sleep(dt)
 
-        if obs == 'sases_average':
-            values = []
-            for i in range(30):
-                sa1 = self.interface.get_value("XFEL.FEL/XGM/XGM.2595.T6/INTENSITY.RAW.TRAIN")
-                values.append(sa1)
-                time.sleep(0.1)
-            return np.mean(values)
+        channels = []
+        n_trains = 0
+        for obs in obses:
+            if obs not in self.obs_channels:
+                continue
+            channels += [c for c in self.obs_channels[obs] if c not in channels]
+            n_trains = max(n_trains, self.obs_n_trains.get(obs, 1))
+
+        readings = {}
+        if channels:
+            rows = self.interface.get_train_values(channels, n_trains)
+            readings = {channel: rows[:, i] for i, channel in
+                        enumerate(channels)}
 
+        return [self._compute_obs(obs, readings) for obs in obses]
 
+    def get_obses_dict(self):
+        obses = self.list_obses()
+        return dict(zip(obses, self.get_obses(obses)))
+
+    def _compute_obs(self, obs, readings):
+        # Readings of the observable channels, first train first
+        n_trains = self.obs_n_trains.get(obs, 1)
+        values = [readings[channel][:n_trains] for channel in
+                  self.obs_channels[obs]]
+
+        if obs == 'sases_average':
+            return np.mean(values[0])
 
     def read_bpms(self, bpms, nreadings):
-        orbits = np.zeros((nreadings, len(bpms)))
-        for i in range(nreadings):
-            for j, bpm in enumerate(bpms):
-                orbits[i, j] = self.interface.get_value(bpm)
-            time.sleep(0.1)
+        orbits = self.interface.get_train_values(bpms, nreadings)
         return np.mean(orbits, axis=0)
-
@@ -1,5 +1,15 @@
-import pydoocs
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
 from badger import interface
+from badger.errors import BadgerInterfaceChannelError
+
+try:
+    import pydoocs
+except ImportError:  # doocs_mock builds on this interface without it
+    pydoocs = None
+
+TRAIN_PERIOD = 0.1  # in second, European XFEL runs at 10 Hz
 
 
 class Interface(interface.Interface):
@@ -9,9 +19,13 @@ class Interface(interface.Interface):
     def __init__(self, params=None):
         super().__init__(params)
 
+        self._executor = None
+
     @staticmethod
     def get_default_params():
-        return None
+        return {
+            'max_workers': 16,  # concurrent reads/writes in get/set_values
+        }
 
     def get_value(self, channel: str):
         val = pydoocs.read(channel)
@@ -20,3 +34,89 @@ class Interface(interface.Interface):
 
     def set_value(self, channel: str, value):
         pydoocs.write(channel, float(value))
+
+    def get_values(self, channel_names):
+        channel_outputs = self.get_tagged_values(channel_names)
+
+        return {channel: value for channel, (value, _) in
+                channel_outputs.items()}
+
+    def get_tagged_values(self, channel_names):
+        # Read all the channels concurrently, return {channel: (value,
+        # train_id)}. The first read that fails raises
+        values = self._get_executor().map(self._read, channel_names)
+
+        return dict(zip(channel_names, values))
+
+    def set_values(self, channel_inputs):
+        # Write all the channels concurrently, raise the first failure once
+        # all the writes are done
+        futures = [self._get_executor().submit(self.set_value, channel, value)
+                   for channel, value in channel_inputs.items()]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def get_train_values(self, channel_names, n_trains, timeout=None,
+                         aligned=False):
+        # Read the channels together on n_trains distinct trains, return a
+        # (n_trains, n_channels) array. A train read twice is only counted
+        # once. Raise if fewer trains could be read within timeout seconds.
+        # If aligned, drop the reads whose channels are not all on one
+        # train. Only scalar channels can be stacked this way, a channel
+        # that returns an array or a string raises
+        channel_names = list(channel_names)
+        if timeout is None:
+            timeout = 3 * n_trains * TRAIN_PERIOD + 1
+
+        readings = {}  # train ID -> row
+        t_start = time.time()
+        while True:
+            outputs = self.get_tagged_values(channel_names)
+            row = []
+            for channel in channel_names:
+                value = outputs[channel][0]
+                if isinstance(value, str) or np.ndim(value):
+                    raise BadgerInterfaceChannelError(
+                        f'{channel} is not a scalar channel')
+                row.append(value)
+
+            # Reads straddling two trains are tagged with the later one
+            train_ids = [outputs[channel][1] for channel in channel_names
+                         if outputs[channel][1] is not None]
+            train_id = max(train_ids) if train_ids else None
+            if aligned and len(set(train_ids)) > 1:
+                train_id = None
+
+            if train_id is not None and train_id not in readings:
+                readings[train_id] = row
+            if len(readings) >= n_trains:
+                break
+            if time.time() - t_start > timeout:
+                break
+
+            # Poll faster than the trains come, the repeats are dropped
+            time.sleep(TRAIN_PERIOD / 2)
+
+        if len(readings) < n_trains:
+            raise BadgerInterfaceChannelError(
+                f'Only {len(readings)} of {n_trains} trains could be read '
+                f'within {timeout:.1f} s')
+
+        return np.array(list(readings.values()), dtype=float).reshape(
+            -1, len(channel_names))
+
+    def _read(self, channel):
+        val = pydoocs.read(channel)
+
+        return val['data'], val['macropulse']
+
+    def _get_executor(self):
+        if self._executor is None:
+            try:
+                max_workers = self.params['max_workers']
+            except (KeyError, TypeError):
+                max_workers = None
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        return self._executor
@@ -1,22 +1,49 @@
-from badger import interface
-
+import time
 from numpy import random
 
+from ..doocs import Interface as DoocsInterface
 
-class Interface(interface.Interface):
+TRAIN_RATE = 10  # in Hz, the European XFEL train repetition rate
 
-    name = 'doocs_mock'
 
-    def __init__(self, params=None):
-        super().__init__(params)
+class Interface(DoocsInterface):
+    # The doocs interface, reading random values instead of pydoocs
+
+    name = 'doocs_mock'
 
     @staticmethod
     def get_default_params():
-        return None
+        return {
+            'max_workers': 16,  # concurrent reads/writes in get/set_values
+            'latency': 0,  # in second, simulated duration of each read/write
+            'verbose': True,
+        }
 
     def get_value(self, channel: str):
-        print("Called get_value for channel: {}.".format(channel))
-        return random.random()
+        value, _ = self._read(channel)
+
+        return value
 
     def set_value(self, channel: str, value):
-        print("Called set_value for channel: {}, with value: {}".format(channel, value))
+        self._wait_latency()
+        if self._get_param('verbose', True):
+            print("Called set_value for channel: {}, with value: {}".format(channel, value))
+
+    def _read(self, channel):
+        self._wait_latency()
+        if self._get_param('verbose', True):
+            print("Called get_value for channel: {}.".format(channel))
+
+        # Tag the value with the train that was running when the read ended
+        return random.random(), int(time.time() * TRAIN_RATE)
+
+    def _wait_latency(self):
+        latency = self._get_param('latency', 0)
+        if latency:
+            time.sleep(latency)
+
+    def _get_param(self, name, default):
+        try:
+            return self.params[name]
+        except (KeyError, TypeError):
+            return default
@@ -1,4 +1,6 @@
+import logging
 import random
+import threading
 import time
 from typing import Dict
 
@@ -13,12 +15,32 @@ epics.ca.DEFAULT_CONNECTION_TIMEOUT = 0.1
 class Interface(interface.Interface):
     name = "epics"
     testing: bool = False
+    # Serve get_values from monitor subscriptions instead of blocking gets
+    monitor: bool = False
+    # in second, optional bound on the age of a cached value. By default a
+    # value is served for as long as its channel stays connected
+    max_age: float = None
+    connection_timeout: float = 1.0  # in second, shared by all the channels
+    # Put all channels at once and verify the readbacks together
+    parallel_put: bool = False
+    put_timeout: float = 5.0  # in second, shared by all the channels
+    # Read array tails through the IOC array filter (needs EPICS base >= 3.15
+    # and no CA gateway in between), falls back on the full array if the
+    # filtered channel cannot connect
+    array_filter: bool = False
 
     # Private variables
     _pvs: Dict = {}
+    _cache: Dict = {}  # channel -> {'value': ..., 'timestamp': ...}
+    _unfiltered: set = set()  # channels that cannot be read through the filter
+    _monitored: set = set()  # channels whose PV feeds the cache
 
     @interface.log
-    def get_values(self, channel_names, as_string: bool = False):
+    def get_values(
+        self, channel_names, as_string: bool = False, counts: Dict = None
+    ):
+        # counts maps channel -> number of elements to read for array PVs,
+        # a negative count reads the tail of the array, like [count:]
         channel_outputs = {}
 
         # if testing generate some random numbers and return
@@ -29,51 +51,95 @@ class Interface(interface.Interface):
 
             return channel_outputs
 
+        if counts is None:
+            counts = {}
+        # The name of the PV actually read for each channel
+        pv_names = {
+            channel: self._get_pv_name(channel, counts.get(channel))
+            for channel in channel_names
+        }
+        pv_counts = {
+            pv_names[channel]: counts.get(channel) for channel in channel_names
+        }
+
+        # Serve what we can from the monitor cache, the rest goes to the
+        # network
+        pending = []
+        for pv_name in set(pv_names.values()):
+            # Monitored values are stored natively, string reads go the slow
+            # way
+            if self.monitor and not as_string:
+                value = self._get_cached_value(pv_name, pv_counts[pv_name])
+                if value is not None:
+                    channel_outputs[pv_name] = value
+                    continue
+
+            pending.append(pv_name)
+
+        connected = self._connect_many(pending)
+
+        # Read the channels the IOC (or a gateway) cannot filter in full, they
+        # are sliced locally by _trim, and do not ask for the filter again
+        fallback = []
         for channel in channel_names:
-            try:
-                pv = self._pvs[channel]
-            except KeyError:
-                pv = epics.get_pv(channel)
-                self._pvs[channel] = pv
+            pv_name = pv_names[channel]
+            if pv_name == channel or pv_name in connected:
+                continue
+            if pv_name not in pending:  # served from the cache
+                continue
 
-            if not pv.wait_for_connection(1):
+            pv_names[channel] = channel
+            pv_counts[channel] = pv_counts.pop(pv_name)
+            pending.remove(pv_name)
+            fallback.append(channel)
+        if fallback:
+            pending += fallback
+            connected.update(self._connect_many(fallback))
+            self._unfiltered.update(c for c in fallback if c in connected)
+
+        for pv_name in pending:
+            if pv_name not in connected:
                 # TODO: consider throwing an exception here
-                channel_outputs[channel] = None
-                continue
+                channel_outputs[pv_name] = None
 
-            count_down = 2  # second
-            flag = True
-            while count_down > 0:
-                value = pv.get(as_string=as_string)
+        # Read all the connected channels together, only retry the invalid
+        # ones
+        count_down = 2  # second
+        while connected:
+            values = self._get_many(
+                connected, as_string=as_string, counts=pv_counts
+            )
 
-                if type(value) is str:
-                    channel_outputs[channel] = value
-                    flag = False
-                    break
+            invalid = {}
+            for pv_name, value in values.items():
+                valid_value = self._validate(
+                    self._trim(value, pv_counts[pv_name])
+                )
+                if valid_value is None:
+                    invalid[pv_name] = connected[pv_name]
+                    continue
 
-                try:
-                    _ = len(value)
-                    value = value[~np.isnan(value)]
-                    if len(value):
-                        channel_outputs[channel] = value
-                        flag = False
-                        break
-                except Exception:
-                    if (value is not None) and (not np.isnan(value)):
-                        channel_outputs[channel] = value
-                        flag = False
-                        break
+                channel_outputs[pv_name] = valid_value
+                if self.monitor and not as_string:
+                    self._update_cache(pv_name, value)
 
-                time.sleep(0.1)
-                count_down -= 0.1
+            connected = invalid
+            if not connected or count_down <= 0:
+                break
 
-            if flag:
-                raise Exception(
-                    f"PV {channel} readout ({channel_outputs[channel]}) "
-                    + "is invalid!"
-                )
+            time.sleep(0.1)
+            count_down -= 0.1
 
-        return channel_outputs
+        for pv_name in connected:
+            raise Exception(
+                f"PV {pv_name} readout ({values[pv_name]}) is invalid!"
+            )
+
+        # Keep the order of the requested channels
+        return {
+            channel: channel_outputs[pv_names[channel]]
+            for channel in channel_names
+        }
 
     @interface.log
     def set_values(self, channel_inputs: Dict) -> Dict:
@@ -85,12 +151,11 @@ class Interface(interface.Interface):
 
             return channel_outputs
 
+        if self.parallel_put:
+            return self._set_many(channel_inputs)
+
         for channel, value in channel_inputs.items():
-            try:
-                pv = self._pvs[channel]
-            except KeyError:
-                pv = epics.get_pv(channel)
-                self._pvs[channel] = pv
+            pv = self._get_pv(channel)
 
             if not pv.wait_for_connection(1):
                 # TODO: consider throwing an exception here
@@ -106,24 +171,296 @@ class Interface(interface.Interface):
             flag = True
             while count_down > 0:
                 _value = pv.get()
-                if value:
-                    if np.isclose(_value, value, rtol=1e-3):
-                        channel_outputs[channel] = _value
-                        flag = False
-                        break
-                else:
-                    if np.isclose(_value, value, atol=1e-3):
-                        channel_outputs[channel] = _value
-                        flag = False
-                        break
+                if self._is_close(_value, value):
+                    channel_outputs[channel] = _value
+                    flag = False
+                    break
 
                 time.sleep(0.1)
                 count_down -= 0.1
 
             if flag:
                 raise Exception(
-                    f"PV {channel} (current: {channel_outputs[channel]}) "
+                    f"PV {channel} (current: {_value}) "
                     + f"cannot reach expected value ({value})!"
                 )
 
         return channel_outputs
+
+    def subscribe(
+        self, channel_names, callback, as_string: bool = False
+    ) -> Dict:
+        # Call callback(channel, value) on every monitor update of the
+        # channels (from the CA thread), and right away with their current
+        # values. A channel that disconnects gets a None value, until the
+        # monitor update that comes with the reconnection. Return the
+        # subscription to pass to unsubscribe, or None if some of the
+        # channels cannot connect
+        if self.testing:
+            return None
+
+        pvs = self._connect_many(channel_names)
+        if len(pvs) != len(channel_names):
+            return None
+
+        updated = set()
+
+        def on_change(pvname=None, value=None, char_value=None, **kwargs):
+            updated.add(pvname)
+            callback(pvname, char_value if as_string else value)
+
+        def on_connection(pvname=None, conn=None, **kwargs):
+            if not conn:
+                callback(pvname, None)
+
+        subscription = {}
+        for channel, pv in pvs.items():
+            pv.connection_callbacks.append(on_connection)
+            subscription[channel] = (
+                pv, pv.add_callback(on_change), on_connection
+            )
+
+        # Seed with the current values, in case none of them changes
+        for channel, value in self._get_many(pvs, as_string=as_string).items():
+            if channel not in updated:
+                callback(channel, value)
+
+        return subscription
+
+    @staticmethod
+    def unsubscribe(subscription: Dict):
+        for pv, index, on_connection in subscription.values():
+            pv.remove_callback(index)
+            if on_connection in pv.connection_callbacks:
+                pv.connection_callbacks.remove(on_connection)
+
+    def wait_for_values(
+        self,
+        channel_names,
+        condition,
+        timeout: float = None,
+        as_string: bool = False,
+    ) -> bool:
+        # Block until condition(values) holds, values being the latest value
+        # of every channel. The condition is evaluated again on every monitor
+        # update, so we return as soon as it is met instead of polling.
+        # Return False if the channels cannot connect or on timeout
+        if self.testing:
+            return True
+
+        lock = threading.Lock()
+        met = threading.Event()
+        values = {}
+
+        def on_change(channel, value):
+            with lock:
+                values[channel] = value
+                if len(values) == len(channel_names) and condition(
+                    dict(values)
+                ):
+                    met.set()
+
+        subscription = self.subscribe(
+            channel_names, on_change, as_string=as_string
+        )
+        if subscription is None:
+            return False
+
+        try:
+            return met.wait(timeout)
+        finally:
+            self.unsubscribe(subscription)
+
+    def _set_many(self, channel_inputs: Dict) -> Dict:
+        # Report success and latency (time from put to a matching readback)
+        # per channel, instead of raising on the first unreachable one
+        channel_outputs = {
+            channel: {"value": None, "success": False, "latency": None}
+            for channel in channel_inputs
+        }
+
+        connected = self._connect_many(list(channel_inputs.keys()))
+
+        time_start = time.time()
+        for channel, pv in connected.items():
+            pv.put(channel_inputs[channel], use_complete=True)
+
+        # Verify all the readbacks together under one shared deadline
+        while connected:
+            values = self._get_many(connected)
+
+            pending = {}
+            for channel, _value in values.items():
+                channel_outputs[channel]["value"] = _value
+                if connected[channel].put_complete and self._is_close(
+                    _value, channel_inputs[channel]
+                ):
+                    channel_outputs[channel]["success"] = True
+                    channel_outputs[channel]["latency"] = (
+                        time.time() - time_start
+                    )
+                else:
+                    pending[channel] = connected[channel]
+
+            connected = pending
+            if not connected or time.time() - time_start > self.put_timeout:
+                break
+
+            time.sleep(0.1)
+
+        for channel, output in channel_outputs.items():
+            if not output["success"]:
+                logging.warning(
+                    f"PV {channel} (current: {output['value']}) "
+                    + "cannot reach expected value "
+                    + f"({channel_inputs[channel]})!"
+                )
+
+        return channel_outputs
+
+    def _connect_many(self, channels) -> Dict:
+        # Create all the missing PVs first so that they connect in parallel,
+        # then wait for all of them under one shared deadline
+        pvs = {channel: self._get_pv(channel) for channel in channels}
+        deadline = time.time() + self.connection_timeout
+        connected = {}
+        for channel, pv in pvs.items():
+            if pv.wait_for_connection(max(deadline - time.time(), 0)):
+                connected[channel] = pv
+
+        return connected
+
+    def _get_pv(self, channel):
+        pv = self._pvs.get(channel)
+        if pv is None:
+            if self.monitor:
+                pv = epics.get_pv(
+                    channel,
+                    auto_monitor=True,
+                    callback=self._on_value_change,
+                    connection_callback=self._on_connection_change,
+                )
+                self._monitored.add(channel)
+            else:
+                pv = epics.get_pv(channel)
+            self._pvs[channel] = pv
+        elif self.monitor and channel not in self._monitored:
+            # Created before monitor was turned on, hook it up to the cache
+            pv.auto_monitor = True
+            pv.add_callback(self._on_value_change)
+            pv.connection_callbacks.append(self._on_connection_change)
+            self._monitored.add(channel)
+
+        return pv
+
+    def _get_pv_name(self, channel, count=None):
+        # Let the IOC cut the tail of the array with a server side filter,
+        # so that only the requested elements cross the wire
+        if not self.array_filter or channel in self._unfiltered:
+            return channel
+
+        if count is not None and count < 0:
+            return f'{channel}.{{"arr":{{"s":{count}}}}}'
+
+        return channel
+
+    @staticmethod
+    def _get_many(
+        pvs: Dict, as_string: bool = False, counts: Dict = None
+    ) -> Dict:
+        if counts is None:
+            counts = {}
+        # Only a head can be requested natively, tails are read in full
+        # unless filtered by the IOC (see _get_pv_name)
+        native_counts = {}
+        for channel in pvs:
+            count = counts.get(channel)
+            native_counts[channel] = count if count and count > 0 else None
+
+        # Issue all the gets before waiting for any of them, like caget_many
+        for channel, pv in pvs.items():
+            epics.ca.get(
+                pv.chid, count=native_counts[channel], as_string=as_string,
+                wait=False
+            )
+        epics.ca.poll()
+
+        return {
+            channel: epics.ca.get_complete(
+                pv.chid, count=native_counts[channel], as_string=as_string
+            )
+            for channel, pv in pvs.items()
+        }
+
+    def _get_cached_value(self, channel, count=None):
+        # Subscribe on first access, the cache fills in from the callbacks
+        pv = self._get_pv(channel)
+
+        try:
+            entry = self._cache[channel]
+        except KeyError:
+            return None
+
+        # The monitor updates keep the value current while the channel is
+        # connected, and _on_connection_change drops it on disconnection
+        if not pv.connected:
+            return None
+        age = time.time() - entry["timestamp"]
+        if self.max_age is not None and age > self.max_age:
+            return None
+
+        return self._validate(self._trim(entry["value"], count))
+
+    def _update_cache(self, channel, value):
+        self._cache[channel] = {"value": value, "timestamp": time.time()}
+
+    def _on_value_change(self, pvname=None, value=None, **kwargs):
+        # Called from the CA thread on every monitor update
+        if value is not None:
+            self._update_cache(pvname, value)
+
+    def _on_connection_change(self, pvname=None, conn=None, **kwargs):
+        # Never serve values from a channel that has gone away
+        if not conn:
+            self._cache.pop(pvname, None)
+
+    @staticmethod
+    def _is_close(readback, value):
+        if readback is None:
+            return False
+
+        if value:
+            return np.isclose(readback, value, rtol=1e-3)
+
+        return np.isclose(readback, value, atol=1e-3)
+
+    @staticmethod
+    def _trim(value, count=None):
+        # Slicing gives a view, nothing is copied
+        if not count or not isinstance(value, np.ndarray):
+            return value
+
+        if count > 0:
+            return value[:count]
+
+        return value[count:]
+
+    @staticmethod
+    def _validate(value):
+        # Return the value, or None if it is not usable. Arrays keep their
+        # NaNs, so that they stay aligned element by element with the other
+        # buffers (e.g. the pulse ID ones), only an all-NaN array is invalid
+        if type(value) is str:
+            return value
+
+        try:
+            _ = len(value)
+            if not len(value) or np.isnan(value).all():
+                return None
+
+            return value
+        except Exception:
+            if (value is not None) and (not np.isnan(value)):
+                return value
+
+        return None
@@ -1,6 +1,8 @@
 import tango
 from badger import interface
 
+from . import fake
+
 
 class Interface(interface.Interface):
 
@@ -9,14 +11,70 @@ class Interface(interface.Interface):
     def __init__(self, params=None):
         super().__init__(params)
 
+        self._proxies = {}  # device -> DeviceProxy, reused across calls
+
     @staticmethod
     def get_default_params():
-        return None
+        return {
+            'testing': False,  # talk to the in-process fake devices instead
+        }
+
+    def get_value(self, channel: str, attr: str = None):
+        # channel is the full attribute name, device/attribute
+        device, attr = self._split(channel)
+        return self._get_proxy(device).read_attribute(attr).value
+
+    def set_value(self, channel: str, value, attr: str = None):
+        # channel is the device, or the full attribute name if attr is None
+        if attr is None:
+            channel, attr = self._split(channel)
+        self._get_proxy(channel).write_attribute(attr, value)
+
+    def get_values(self, channel_names):
+        # One read_attributes call per device
+        channel_outputs = {}
+        for device, channels in self._group(channel_names).items():
+            attrs = [attr for _, attr in channels]
+            replies = self._get_proxy(device).read_attributes(attrs)
+            for (channel, _), reply in zip(channels, replies):
+                channel_outputs[channel] = reply.value
+
+        return channel_outputs
+
+    def set_values(self, channel_inputs):
+        # One write_attributes call per device
+        for device, channels in self._group(channel_inputs).items():
+            self._get_proxy(device).write_attributes(
+                [(attr, channel_inputs[channel]) for channel, attr in channels])
+
+    def _get_proxy(self, device):
+        try:
+            return self._proxies[device]
+        except KeyError:
+            pass
+
+        try:
+            testing = self.params['testing']
+        except (KeyError, TypeError):
+            testing = False
+        if testing:
+            proxy = fake.DeviceProxy(device)
+        else:
+            proxy = tango.DeviceProxy(device)
+        self._proxies[device] = proxy
+
+        return proxy
+
+    @staticmethod
+    def _split(channel):
+        device, attr = channel.rsplit('/', 1)
+        return device, attr
 
-    def get_value(self, channel: str, attr: str):
-        attr = tango.AttributeProxy(channel)
-        return attr.read().value
+    def _group(self, channels):
+        # device -> [(channel, attribute)], in the given order
+        groups = {}
+        for channel in channels:
+            device, attr = self._split(channel)
+            groups.setdefault(device, []).append((channel, attr))
 
-    def set_value(self, channel: str, value, attr: str):
-        dev = tango.DeviceProxy(channel)
-        dev.write_attribute(attr, value)
+        return groups
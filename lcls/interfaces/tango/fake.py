@@ -0,0 +1,36 @@
+import time
+from collections import namedtuple
+
+DeviceAttribute = namedtuple('DeviceAttribute', ['name', 'value'])
+
+
+class DeviceProxy:
+    # In-process stand-in for tango.DeviceProxy, to test without a TANGO
+    # database. The attributes of a device are shared by all its proxies,
+    # and only exist once written
+    connect_delay = 0  # in second, simulated name-service lookup + connect
+    devices = {}  # device -> {attribute: value}
+
+    def __init__(self, device: str):
+        time.sleep(self.connect_delay)
+        self._device = device
+        self._attributes = self.devices.setdefault(device, {})
+
+    def dev_name(self):
+        return self._device
+
+    def read_attribute(self, attr: str):
+        try:
+            return DeviceAttribute(attr, self._attributes[attr])
+        except KeyError:
+            raise KeyError(f"Attribute {attr} is unknown on {self._device}.")
+
+    def read_attributes(self, attrs):
+        return [self.read_attribute(attr) for attr in attrs]
+
+    def write_attribute(self, attr: str, value):
+        self._attributes[attr] = value
+
+    def write_attributes(self, attrs_values):
+        for attr, value in attrs_values:
+            self.write_attribute(attr, value)
@@ -1,8 +1,31 @@
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import at
 from badger import interface
 
+# Copy of the ring in a worker process, sent once when the worker starts
+_worker_ring = None
+_worker_indskew = None
+
+
+def get_vertical_emittance(ring):
+    _, beamdata1, _ = at.ohmi_envelope(ring)
+    vert_emitt = beamdata1.mode_emittances[1]
+    return vert_emitt
+
+
+def _init_worker(ring, indskew):
+    global _worker_ring, _worker_indskew
+    _worker_ring = ring
+    _worker_indskew = indskew
+
+
+def _evaluate(strengths):
+    # Runs in a worker process, only the skew quad strengths are sent over
+    at.set_value_refpts(_worker_ring, _worker_indskew, 'PolynomA', strengths, 1)
+    return get_vertical_emittance(_worker_ring)
+
 
 class Interface(interface.Interface):
     name = 'tango_mock'
@@ -15,25 +38,91 @@ class Interface(interface.Interface):
         self.ring.radiation_on()
         self.sqpinput = 0.01*np.random.rand((288))*10e-3
 
+        # Vertical emittance of the ring as it is, None when a skew quad
+        # changed since it was computed
+        self._vert_emitt = None
+        self._sqp_value = None  # last skew quad strengths set
+        self._future = None  # pending computation in the process pool
+        self._executor = None
+
     @staticmethod
     def get_default_params():
-        return None
+        return {
+            'n_workers': 0,  # > 0 computes the envelope in a process pool
+            'verbose': True,
+        }
 
     def get_value(self, channel: str, attr=None):
-        print('Called get_value for channel: {}.'.format(channel))
+        if self._get_param('verbose', True):
+            print('Called get_value for channel: {}.'.format(channel))
         if channel == 'srdiag/emittance/id07/Emittance_V':
-            _, beamdata1, _ = at.ohmi_envelope(self.ring)
-            vert_emitt=beamdata1.mode_emittances[1]
-            return vert_emitt
+            if self._vert_emitt is None:
+                if self._future is not None:
+                    self._vert_emitt = self._future.result()
+                    self._future = None
+                else:
+                    self._vert_emitt = get_vertical_emittance(self.ring)
+            return self._vert_emitt
 
         raise KeyError(f"Channel {channel} is unknown.")
 
     def set_value(self, channel: str, attr: str, value):
-        print("Called set_value for channel: {}, with value: {}".format(channel, value))
+        if self._get_param('verbose', True):
+            print("Called set_value for channel: {}, with value: {}".format(channel, value))
         if channel == 'srmag/sqp/all':
-            print(f"value: {type(value)}")
-            print(f"sqpinput: {type(self.sqpinput)}")
+            if self._sqp_value is not None and np.array_equal(value, self._sqp_value):
+                return
             at.set_value_refpts(self.ring, self.indskew, 'PolynomA', value + self.sqpinput, 1)
+            self._sqp_value = np.array(value, copy=True)
+            self._vert_emitt = None
+
+            # Start on the new lattice right away, the next read waits for it
+            executor = self._get_executor()
+            if executor is not None:
+                self._future = executor.submit(_evaluate, value + self.sqpinput)
             return
         raise KeyError(f"Channel {channel} is unknown.")
-    
\ No newline at end of file
+
+    def get_emittances(self, values):
+        # Vertical emittance for each of the given skew quad strengths, spread
+        # over the process pool. The skew quads of the interface are left as
+        # they are
+        strengths = [value + self.sqpinput for value in values]
+        executor = self._get_executor()
+        if executor is not None:
+            return list(executor.map(_evaluate, strengths))
+
+        ring = self.ring.deepcopy()
+        emittances = []
+        for sqp in strengths:
+            at.set_value_refpts(ring, self.indskew, 'PolynomA', sqp, 1)
+            emittances.append(get_vertical_emittance(ring))
+
+        return emittances
+
+    def close(self):
+        # Stop the worker processes, a later computation starts new ones
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        self._future = None
+
+    def _get_param(self, name, default):
+        try:
+            return self.params[name]
+        except (KeyError, TypeError):
+            return default
+
+    def _get_executor(self):
+        n_workers = self._get_param('n_workers', 0)
+        if not n_workers:
+            return None
+
+        if self._executor is None:
+            # Each worker gets its copy of the ring once, the tasks only carry
+            # the skew quad strengths
+            self._executor = ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_init_worker,
+                initargs=(self.ring, self.indskew))
+
+        return self._executor